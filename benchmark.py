@@ -0,0 +1,133 @@
+""" Benchmarks cccReader.parse() against synthetic exports
+
+    Each run parses one generated export into either in-memory or file SQLite, in its own
+    process so peak RSS belongs to that run alone, and reports objects per second along
+    with the per phase breakdown from cccReader's instrumentation.
+"""
+
+import cccReader
+import dblayer as db_layer
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import synthetic
+import tempfile
+import time
+from optparse import OptionParser
+
+default_scales = (1000, 10000, 100000)
+targets = ('memory', 'file')
+
+def _seed_luns(dbconn, luns):
+    """ Loads the synthetic LUN catalogue, so disks resolve like they would against a real array """
+    raid_group = db_layer.RAIDGroup(group_number=0)
+    dbconn.add(raid_group)
+    frames = {}
+    for serial, alu, wwn in luns:
+        if serial not in frames:
+            frames[serial] = db_layer.Frame(serial_number=serial)
+            dbconn.add(db_layer.Drive(location='0_0_%d' % len(frames), raidgroup=raid_group, frame=frames[serial]))
+        dbconn.add(db_layer.LUN(wwn=wwn, alu=alu, raid_group=raid_group))
+    dbconn.commit()
+
+def _run(queue, xml, db_engine, luns, streaming):
+    """ Child side of a single run, puts (seconds, peak RSS, report) on the queue """
+    try:
+        start = time.time()
+        reader = cccReader.cccReader(xml, is_shared_db=False, db_engine=db_engine, streaming=streaming, instrument=True)
+        _seed_luns(reader.dbconn, luns)
+        reader.parse()
+        seconds = time.time() - start
+        queue.put((seconds, reader.report.phases[-1].peak_rss_kb, reader.report.to_dict(), None))
+    except Exception, e:
+        queue.put((None, None, None, "%s: %s" % (e.__class__.__name__, e)))
+
+def run_once(xml, target, workdir, luns, streaming=False):
+    """ Parses xml into a fresh database in a child process, returns (seconds, peak RSS KB, report, error) """
+    if target == 'memory':
+        db_engine = 'sqlite:///:memory:'
+    else:
+        db_path = os.path.join(workdir, 'benchmark.db')
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        db_engine = 'sqlite:///' + db_path
+
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run, args=(queue, xml, db_engine, luns, streaming))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+def benchmark(scales=default_scales, namespace=True, streaming=False, workdir=None):
+    """ Runs every scale against every target, returns a list of result dicts """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='cccbench')
+
+    results = []
+    try:
+        for scale in scales:
+            config = synthetic.scaled_config(scale, namespace=namespace)
+            xml = os.path.join(workdir, 'synthetic_%d.xml' % scale)
+            counts = synthetic.generate(xml, **config)
+            luns = synthetic.lun_catalogue(config)
+
+            for target in targets:
+                seconds, peak_rss_kb, report, error = run_once(xml, target, workdir, luns, streaming)
+                result = {'scale': scale,
+                          'objects': counts['objects'],
+                          'file_bytes': os.path.getsize(xml),
+                          'target': target,
+                          'namespace': namespace,
+                          'streaming': streaming,
+                          'seconds': seconds,
+                          'objects_per_second': seconds and counts['objects'] / seconds or None,
+                          'peak_rss_kb': peak_rss_kb,
+                          'report': report,
+                          'error': error}
+                results.append(result)
+                _print_result(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def _print_result(result):
+    if result['error']:
+        print "%8d %-7s FAILED %s" % (result['scale'], result['target'], result['error'])
+    else:
+        print "%8d %-7s %9d objects %10.2fs %12.0f obj/s %10s KB peak" % \
+                    (result['scale'], result['target'], result['objects'], result['seconds'],
+                     result['objects_per_second'], result['peak_rss_kb'])
+    sys.stdout.flush()
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] [scale ...]")
+    parser.add_option('--no-namespace', dest='namespace', action='store_false', default=True,
+                      help="benchmark CCC 1.3 style exports with no namespace")
+    parser.add_option('-s', '--streaming', dest='streaming', action='store_true', default=False,
+                      help="parse in streaming mode")
+    parser.add_option('-j', '--json', dest='json', default=None, metavar='FILE',
+                      help="also write the results, with per phase reports, to FILE as JSON")
+    parser.add_option('-w', '--workdir', dest='workdir', default=None,
+                      help="keep generated exports and databases here rather than a temp dir")
+    options, args = parser.parse_args(argv)
+
+    scales = [int(arg) for arg in args] or default_scales
+    results = benchmark(scales, options.namespace, options.streaming, options.workdir)
+
+    if options.json:
+        output = open(options.json, 'w')
+        try:
+            json.dump(results, output, indent=2)
+        finally:
+            output.close()
+
+    failed = [result for result in results if result['error']]
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+""" Columnar output of a parsed CCC export, no database involved
+
+    ColumnarSink takes cccReader's records and writes one file per record type into a
+    directory: CSV rows as each batch arrives, and with numpy installed a .npz holding one
+    array per field once the parse is done. The VolumeRelationship and ClientPool files are
+    the volume graph and client to pool edge lists, so analytics can join on plain id arrays.
+"""
+
+import cccReader
+import csv
+import datetime
+import model
+import os
+import sys
+from optparse import OptionParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+formats = ('csv', 'npz')
+default_formats = numpy is None and ('csv',) or formats
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def as_array(values):
+    """ Turns a column into a numpy array
+
+        Whole number columns come back as int64, or float64 with NaN for the gaps if any
+        are missing. Everything else comes back as unicode, missing values as ''.
+    """
+    present = [value for value in values if value is not None]
+    if present and all([isinstance(value, (int, long, float)) and not isinstance(value, bool) for value in present]):
+        if len(present) == len(values) and all([isinstance(value, (int, long)) for value in present]):
+            return numpy.array(values, dtype=numpy.int64)
+        return numpy.array([value is None and numpy.nan or value for value in values], dtype=numpy.float64)
+    return numpy.array([str(_text(value)).decode('utf-8') for value in values], dtype=numpy.unicode_)
+
+class ColumnarSink(object):
+    """ Writes records to <directory>/<record type>.csv and .npz
+
+        CSV is written as batches arrive. For npz the columns are held until close(),
+        which also has to be called to finish the CSV files. With no directory the
+        columns are only kept in memory, see columns() and arrays().
+    """
+
+    def __init__(self, directory=None, formats=default_formats):
+        if 'npz' in formats and numpy is None:
+            raise ImportError("npz output needs numpy")
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.formats = formats
+        self.keep_columns = directory is None or 'npz' in formats
+        self._columns = {}
+        self._csv = {}
+
+    def write(self, records):
+        record_type = type(records[0])
+
+        if self.directory is not None and 'csv' in self.formats:
+            if record_type not in self._csv:
+                output = open(os.path.join(self.directory, record_type.__name__ + '.csv'), 'wb')
+                writer = csv.writer(output)
+                writer.writerow(record_type._fields)
+                self._csv[record_type] = (output, writer)
+            writer = self._csv[record_type][1]
+            writer.writerows([[_text(value) for value in record] for record in records])
+
+        if self.keep_columns:
+            if record_type not in self._columns:
+                self._columns[record_type] = tuple([[] for field in record_type._fields])
+            for column, values in zip(self._columns[record_type], zip(*records)):
+                column.extend(values)
+
+    def end_phase(self):
+        for output, writer in self._csv.values():
+            output.flush()
+
+    def columns(self, record_type):
+        """ Returns {field: list of values} for a record type, empty lists if none were parsed """
+        columns = self._columns.get(record_type) or [[] for field in record_type._fields]
+        return dict(zip(record_type._fields, columns))
+
+    def arrays(self, record_type):
+        """ Returns {field: numpy array} for a record type """
+        return dict([(field, as_array(values)) for field, values in self.columns(record_type).items()])
+
+    def close(self):
+        for output, writer in self._csv.values():
+            output.close()
+        self._csv = {}
+
+        if self.directory is not None and 'npz' in self.formats:
+            for record_type in model.record_types:
+                path = os.path.join(self.directory, record_type.__name__ + '.npz')
+                numpy.savez(path, **self.arrays(record_type))
+
+def export(ccc_config_xml, directory, formats=default_formats, streaming=True, batch_size=1000):
+    """ Parses an export straight into columnar files, returns the reader
+
+        There's no LUN catalogue without a database, so disks come out with no WWN.
+    """
+    sink = ColumnarSink(directory, formats)
+    reader = cccReader.cccReader(ccc_config_xml, streaming=streaming, batch_size=batch_size, sink=sink)
+    try:
+        reader.parse()
+    finally:
+        sink.close()
+    return reader
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] export.xml output_directory")
+    parser.add_option('-f', '--format', dest='formats', action='append', choices=formats, default=None,
+                      help="csv or npz, may be given twice [default: csv, plus npz if numpy is installed]")
+    parser.add_option('--no-streaming', dest='streaming', action='store_false', default=True,
+                      help="load the export whole rather than streaming it")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("one export and one output directory please")
+
+    chosen = options.formats or default_formats
+    if 'npz' in chosen and numpy is None:
+        parser.error("npz output needs numpy")
+
+    export(args[0], args[1], chosen, options.streaming)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
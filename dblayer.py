@@ -1,6 +1,8 @@
 from sqlalchemy import *
 from sqlalchemy.orm import mapper,relation,backref
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import DDLElement
 
 Base = declarative_base()
 
@@ -44,6 +46,14 @@ class NAS(Base):
     control_station_1_ip = Column('CS01IP', String(25))
     control_station_2_ip = Column('CS02IP', String(25))
 
+class NASExport(Base):
+    """ Last CCC export loaded for a NAS """
+    __tablename__ = 'NasExport'
+
+    serial_number = Column('SerialNumber', String(25), ForeignKey('NAS.SerialNumber'), primary_key=True, nullable=False)
+    hash = Column('Hash', String(40), nullable=False)
+    loaded = Column('Loaded', DateTime)
+    nas = relation('NAS', backref=backref('export', uselist=False))
 
 class NASDisk(Base):
     """ Disk Object """
@@ -75,6 +85,8 @@ class Volume(Base):
     type = Column('Type', String(25))
     name = Column('Name', String(25))
     poolid = Column('PoolID', Integer, ForeignKey('Pools.ID'))
+    serial_number = Column('NASSerialNumber', String(25), ForeignKey('NAS.SerialNumber'))
+    nas = relation('NAS', backref='volumes')
     parents = relation(
                     'Volume',secondary=VolumeRelationship,
                     primaryjoin=VolumeRelationship.c.VolumeID==id,
@@ -97,6 +109,10 @@ class Pool(Base):
     description = Column('Description', String(40), nullable=False)
     in_use = Column('InUse', SMALLINT, nullable=False)
     profile = Column('VolumeProfile', String(10), nullable=False)
+    total_capacity = Column('TotalCapacity', Integer)
+    used_capacity = Column('UsedCapacity', Integer)
+    serial_number = Column('NASSerialNumber', String(25), ForeignKey('NAS.SerialNumber'))
+    nas = relation('NAS', backref='pools')
     
 class Client(Base):
     """ Client Filesystems """
@@ -109,13 +125,15 @@ class Client(Base):
     ro_host_id = Column('RODMID', String(60), ForeignKey('DataMover.DataMoverID'))
     rw_host_id = Column('RWDMID', String(60), ForeignKey('DataMover.DataMoverID'))
     parent_client_id = Column('ParentClientID',Integer,ForeignKey('Client.ClientID'))
-    parent = relation('Client', backref=backref('children', remote_side="Client.client_id"))
+    parent = relation('Client', remote_side="Client.client_id", backref='children')
     total_size = Column('totalSize', BigInteger)
     free_size = Column('FreeSize', BigInteger)
     used_size = Column('UsedSize', BigInteger)
     volume_id = Column('VolumeID', Integer, ForeignKey('Volumes.ID'))
     volume = relation('Volume', backref='clients')
     pools = relation('Pool', secondary=ClientPoolRelationship, backref='clients')
+    serial_number = Column('NASSerialNumber', String(25), ForeignKey('NAS.SerialNumber'))
+    nas = relation('NAS', backref='clients')
 
 class Datamover(Base):
     """ Datamover object """
@@ -133,7 +151,8 @@ class CIFSserver(Base):
     """ CIFS server object """
     __tablename__ = 'CifsServers'
     
-    name = Column('Name', String(30), nullable=False, primary_key=True)
+    server_id = Column('CifsServerID', Integer, primary_key=True, nullable=False, autoincrement=True)
+    name = Column('Name', String(30), nullable=False)
     ip = Column('IP', String(15))
     domain = Column('Domain', String(40))
     datamover_id = Column('DatamoverID', ForeignKey('DataMover.DataMoverID'))
@@ -142,11 +161,218 @@ class CIFSserver(Base):
 class Export(Base):
     """ Export Object """
     __tablename__ = 'Export'
-    cifs_server_id = Column('CifsServerName', String(30), ForeignKey('CifsServers.Name'))
+    cifs_server_id = Column('CifsServerID', Integer, ForeignKey('CifsServers.CifsServerID'))
     cifs_server = relation('CIFSserver', backref='exports')
+    cifs_server_name = Column('CifsServerName', String(30))   # As the share names it, resolved or not
     share_id = Column('ExportID', Integer, autoincrement=True, primary_key=True)
     share_name = Column('ShareName', String(100), nullable=False)
     share_path = Column('ClientShare', String(100), nullable=False)
     client_id = Column('ClientID', Integer, ForeignKey('Client.ClientID'))
     client = relation('Client', backref='exports')
+    serial_number = Column('NASSerialNumber', String(25), ForeignKey('NAS.SerialNumber'))
+    nas = relation('NAS', backref='shares')
     
+
+# Secondary indexes for the lookups we (and reporting) run all the time. create_all builds
+# them with the tables, create_schema(profile='bulk') leaves them until build_lookup_indexes()
+lookup_indexes = (Index('ix_Volumes_Name', Volume.__table__.c.Name),
+                  Index('ix_Volumes_NASSerialNumber', Volume.__table__.c.NASSerialNumber),
+                  Index('ix_LUNS_ALU', LUN.__table__.c.ALU),
+                  Index('ix_Frame_SerialNumber', Frame.__table__.c.SerialNumber),
+                  Index('ix_Client_name', Client.__table__.c.name),
+                  Index('ix_Client_NASSerialNumber', Client.__table__.c.NASSerialNumber),
+                  Index('ix_Pools_NASSerialNumber', Pool.__table__.c.NASSerialNumber),
+                  Index('ix_DataMover_NASSerialNumber', Datamover.__table__.c.NASSerialNumber),
+                  Index('ix_NasDisk_NASSerialNumber', NASDisk.__table__.c.NASSerialNumber),
+                  Index('ix_NasDisk_WWN', NASDisk.__table__.c.WWN),
+                  Index('ix_NasDisk_VolumeID', NASDisk.__table__.c.VolumeID),
+                  Index('ix_Client_VolumeID', Client.__table__.c.VolumeID),
+                  Index('ix_Client_ParentClientID', Client.__table__.c.ParentClientID),
+                  Index('ix_CifsServers_DatamoverID', CIFSserver.__table__.c.DatamoverID),
+                  Index('ix_Export_CifsServerID', Export.__table__.c.CifsServerID),
+                  Index('ix_Export_ClientID', Export.__table__.c.ClientID),
+                  Index('ix_Export_NASSerialNumber', Export.__table__.c.NASSerialNumber),
+                  Index('ix_VolumeRelationship_ParentID', VolumeRelationship.c.ParentID),
+                  Index('ix_VolumeRelationship_VolumeID', VolumeRelationship.c.VolumeID),
+                  Index('ix_ClientPools_PoolID', ClientPoolRelationship.c.PoolID),
+                  Index('ix_ClientPools_ClientID', ClientPoolRelationship.c.ClientID))
+
+schema_profiles = ('query', 'bulk')
+
+def _existing_indexes(bind):
+    inspector = inspect(bind)
+    existing = set()
+    for table in set([index.table.name for index in lookup_indexes]):
+        existing.update([index['name'] for index in inspector.get_indexes(table)])
+    return existing
+
+def drop_lookup_indexes(bind):
+    """ Drops whichever lookup indexes exist, so a bulk load doesn't maintain them row by row """
+    existing = _existing_indexes(bind)
+    for index in lookup_indexes:
+        if index.name in existing:
+            index.drop(bind)
+
+def build_lookup_indexes(bind):
+    """ Builds whichever lookup indexes are missing """
+    existing = _existing_indexes(bind)
+    for index in lookup_indexes:
+        if index.name not in existing:
+            index.create(bind)
+
+class AddColumn(DDLElement):
+    """ ALTER TABLE to add a column, spelt for each dialect below """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+@compiles(AddColumn)
+def _add_column(element, compiler, **kw):
+    return 'ALTER TABLE %s ADD COLUMN %s' % (compiler.preparer.format_table(element.table),
+                                             compiler.get_column_specification(element.column))
+
+@compiles(AddColumn, 'mssql')
+def _add_column_mssql(element, compiler, **kw):
+    return 'ALTER TABLE %s ADD %s' % (compiler.preparer.format_table(element.table),
+                                      compiler.get_column_specification(element.column))
+
+def _export_serial():
+    """ An export's NAS serial, from its filesystem or else its CIFS server's mover """
+    export = Export.__table__
+    client = Client.__table__
+    server = CIFSserver.__table__
+    mover = Datamover.__table__
+    by_client = select([client.c.NASSerialNumber]).where(client.c.ClientID == export.c.ClientID).as_scalar()
+    by_server = select([mover.c.NASSerialNumber]).where(and_(server.c.CifsServerID == export.c.CifsServerID,
+                                                             mover.c.DataMoverID == server.c.DatamoverID)).as_scalar()
+    return func.coalesce(by_client, by_server)
+
+# Tables that gained a NAS serial after the tables they point at had one, and how to work
+# theirs out from those when the database holds several arrays
+_serial_owners = {'Export': _export_serial}
+
+def _export_server_name():
+    """ The name of an export's CIFS server, for exports that only kept its id """
+    export = Export.__table__
+    server = CIFSserver.__table__
+    return select([server.c.Name]).where(server.c.CifsServerID == export.c.CifsServerID).as_scalar()
+
+# Columns added since their value could be told from other tables, filled in when they're added
+_column_fills = {('Export', 'CifsServerName'): _export_server_name}
+
+def _missing_columns(bind):
+    """ Returns [(table, [columns])] for the columns existing tables don't have yet """
+    inspector = inspect(bind)
+    existing = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        have = set([column['name'] for column in inspector.get_columns(table.name)])
+        columns = [column for column in table.columns if column.name not in have]
+        if columns:
+            missing.append((table, columns))
+    return missing
+
+def _cifs_servers_by_name(bind):
+    """ Whether CifsServers is still keyed by Name alone, as before it had a CifsServerID """
+    inspector = inspect(bind)
+    return 'CifsServers' in inspector.get_table_names() and \
+           'CifsServerID' not in [column['name'] for column in inspector.get_columns('CifsServers')]
+
+def _rekey_cifs_servers(connection):
+    """ Rebuilds CifsServers keyed by CifsServerID, numbered in name order, and Export pointing
+        at it by id. Names were unique while they were the key, so each export's
+        CifsServerName maps to one server at most, and is kept either way. """
+    old = MetaData()
+    old_servers = Table('CifsServers', old, autoload=True, autoload_with=connection)
+    old_exports = Table('Export', old, autoload=True, autoload_with=connection)
+    servers = [dict(row) for row in connection.execute(select([old_servers]).order_by(old_servers.c.Name))]
+    exports = [dict(row) for row in connection.execute(select([old_exports]))]
+    old_exports.drop(connection)
+    old_servers.drop(connection)
+    CIFSserver.__table__.create(connection)
+    Export.__table__.create(connection)
+
+    server_ids = {}
+    for server_id, server in enumerate(servers):
+        server['CifsServerID'] = server_ids[server['Name']] = server_id + 1
+    for export in exports:
+        export['CifsServerID'] = server_ids.get(export['CifsServerName'])
+    if servers:
+        connection.execute(CIFSserver.__table__.insert(), servers)
+    if exports:
+        connection.execute(Export.__table__.insert(), exports)
+
+def migrate_schema(bind):
+    """ Brings tables an older cccReader created up to date
+
+        create_all leaves existing tables as they are, so without this every INSERT into a
+        database from before Volumes, Pools, Client and Export carried their NAS serial number
+        (or Pools their capacity) fails. New columns are added empty, or filled from the
+        tables that hold their value (see _column_fills), and the serial numbers are
+        filled in, with the one NAS a database holds or, with several, from the rows each one
+        points at (see _serial_owners). A database holding several arrays whose rows can't be
+        told apart that way raises a ValueError, as does any change that can't be made by
+        adding a column, before anything is altered. CifsServers keyed by Name, with Export
+        pointing at it by CifsServerName, is rebuilt with CifsServerID keys (see
+        _rekey_cifs_servers).
+    """
+    rekey = _cifs_servers_by_name(bind)
+    missing = [(table, columns) for table, columns in _missing_columns(bind)
+               if not (rekey and table.name in ('CifsServers', 'Export'))]
+    for table, columns in missing:
+        stuck = [column.name for column in columns if column.primary_key or not column.nullable]
+        if stuck:
+            raise ValueError("%s was created by an older cccReader and %s.%s can't be added to it, "
+                             "load into a new database" % (bind.url, table.name, ', '.join(stuck)))
+    if not missing and not rekey:
+        return
+
+    # Tables whose rows need their NAS serial filled in, a rebuilt Export among them
+    unowned = [table for table, columns in missing if 'NASSerialNumber' in [column.name for column in columns]]
+    if rekey:
+        unowned.append(Export.__table__)
+    serials = [row[0] for row in bind.execute(select([NAS.__table__.c.SerialNumber]))]
+    if len(serials) > 1:
+        for table in unowned:
+            if table.name not in _serial_owners or rekey:
+                raise ValueError("%s holds %d arrays loaded before %s carried a NAS serial number, which rows "
+                                 "belong to which can't be told, load into a new database" %
+                                 (bind.url, len(serials), table.name))
+            orphans = bind.execute(select([func.count()]).select_from(table)
+                                   .where(_serial_owners[table.name]() == None)).scalar()
+            if orphans:
+                raise ValueError("%s holds %d arrays and %d %s rows that can't be told apart by NAS serial number, "
+                                 "load into a new database" % (bind.url, len(serials), orphans, table.name))
+
+    with bind.begin() as connection:
+        if rekey:
+            _rekey_cifs_servers(connection)
+        for table, columns in missing:
+            for column in columns:
+                connection.execute(AddColumn(table, column))
+                if (table.name, column.name) in _column_fills:
+                    connection.execute(table.update().values({column: _column_fills[(table.name, column.name)]()}))
+
+        if not serials:
+            return
+        for table in unowned:
+            if len(serials) == 1:
+                serial = serials[0]
+            else:
+                serial = _serial_owners[table.name]()
+            connection.execute(table.update().where(table.c.NASSerialNumber == None).values(NASSerialNumber=serial))
+
+def create_schema(bind, profile='query'):
+    """ Creates any missing tables and columns (see migrate_schema), with the 'bulk' profile
+        their lookup indexes are left off and with 'query' any missing ones are built """
+    if profile not in schema_profiles:
+        raise ValueError("unknown schema profile %r" % (profile))
+    migrate_schema(bind)
+    Base.metadata.create_all(bind)
+    if profile == 'bulk':
+        drop_lookup_indexes(bind)
+    else:
+        build_lookup_indexes(bind)
@@ -0,0 +1,185 @@
+""" Incremental re-ingest of a CCC export against what's already loaded for its NAS
+
+    The export is parsed into row batches as usual (see sinks.BatchSink), then every
+    table is matched by natural key against the rows stored for the same NAS serial. Only
+    rows that were added, changed or dropped get written, and an export whose file hash
+    has already been loaded doesn't need parsing at all.
+"""
+
+import dblayer as db_layer
+import hashlib
+from sqlalchemy import *
+
+# Natural key of each table within one NAS, foreign keys are compared once mapped to stored ids
+natural_keys = {'NAS': ('SerialNumber',),
+                'NasExport': ('SerialNumber',),
+                'Pools': ('Name',),
+                'Volumes': ('Name',),
+                'VolumeRelationship': ('ParentID', 'VolumeID'),
+                'DataMover': ('Name',),
+                'CifsServers': ('DatamoverID', 'Name'),
+                'Client': ('name',),
+                'ClientPools': ('PoolID', 'ClientID'),
+                'Export': ('ShareName', 'CifsServerName', 'CifsServerID'),
+                'NasDisk': ('VolumeID',)}
+
+# Tables with no NAS serial of their own belong to the NAS that owns the row this column points at
+_owner_columns = {'CifsServers': 'DatamoverID',
+                  'VolumeRelationship': 'VolumeID',
+                  'ClientPools': 'ClientID'}
+
+def file_hash(path):
+    """ SHA1 of an export file, read in chunks """
+    digest = hashlib.sha1()
+    source = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: source.read(1024*1024), ''):
+            digest.update(chunk)
+    finally:
+        source.close()
+    return digest.hexdigest()
+
+def loaded_hashes(dbconn):
+    """ Returns the hashes of every export currently loaded """
+    return set([export_hash for (export_hash,) in dbconn.query(db_layer.NASExport.hash)])
+
+def is_loaded(dbconn, export_hash):
+    return dbconn.query(db_layer.NASExport).filter(db_layer.NASExport.hash==export_hash).count() > 0
+
+def batch_hashes(batches):
+    """ Returns the hashes of the exports a set of row batches were parsed from """
+    return [row['Hash'] for table, rows in batches if table == 'NasExport' for row in rows]
+
+def _owned(table, serial):
+    """ Where clause for the rows of a table that belong to one NAS """
+    if table.name in _owner_columns:
+        column = table.c[_owner_columns[table.name]]
+        target = list(column.foreign_keys)[0].column
+        return column.in_(select([target]).where(_owned(target.table, serial)))
+    if 'NASSerialNumber' in table.c:
+        return table.c.NASSerialNumber==serial
+    return table.c.SerialNumber==serial
+
+def _same(stored, parsed):
+    """ Compares a stored value with a parsed one, mover ids in RODMID/RWDMID come back as text """
+    if stored == parsed:
+        return True
+    return stored is not None and parsed is not None and unicode(stored) == unicode(parsed)
+
+def apply_delta(dbconn, batches):
+    """ Writes only the differences between an export's row batches and what's stored for its NAS
+
+        Rows matched by natural key keep their stored ids, new rows get ids past the current
+        max and foreign keys are mapped to match. Returns {table: (inserted, updated, deleted)},
+        the caller owns the transaction.
+    """
+    parsed = {}
+    for table_name, rows in batches:
+        parsed.setdefault(table_name, []).extend(rows)
+    serial = parsed['NAS'][0]['SerialNumber']
+
+    id_map = {}
+    inserts = []
+    updates = []
+    deletes = []
+    for table in db_layer.Base.metadata.sorted_tables:
+        if table.name not in natural_keys:
+            continue  # The LUN catalogue and friends aren't ours to touch
+        rows = parsed.get(table.name, [])
+        keys = natural_keys[table.name]
+        pk = [column.key for column in table.primary_key]
+        pk = pk and pk[0] or None
+        numbered = pk is not None and isinstance(table.c[pk].type, Integer)
+
+        # Point foreign keys at stored ids, references within the table wait until we've numbered it
+        self_refs = []
+        for column in table.columns:
+            for fk in column.foreign_keys:
+                if not isinstance(fk.column.type, Integer):
+                    continue
+                if fk.column.table is table:
+                    self_refs.append(column.key)
+                    continue
+                mapping = id_map[fk.column.table.name]
+                for row in rows:
+                    if row[column.key] is not None:
+                        row[column.key] = mapping[row[column.key]]
+
+        stored = {}
+        for row in dbconn.execute(select([table]).where(_owned(table, serial))):
+            row = dict(row)
+            stored[tuple([row[key] for key in keys])] = row
+
+        if numbered:
+            next_id = dbconn.query(func.max(table.c[pk])).scalar() or 0
+            id_map[table.name] = {}
+
+        seen = set()
+        matched = []
+        added = []
+        for row in rows:
+            key = tuple([row[key] for key in keys])
+            seen.add(key)
+            old = stored.get(key)
+            if numbered:
+                if old is not None:
+                    new_id = old[pk]
+                else:
+                    next_id += 1
+                    new_id = next_id
+                id_map[table.name][row[pk]] = new_id
+                row[pk] = new_id
+            if old is None:
+                added.append(row)
+            else:
+                matched.append((old, row))
+
+        for column in self_refs:
+            for row in rows:
+                if row[column] is not None:
+                    row[column] = id_map[table.name][row[column]]
+
+        changed = []
+        for old, row in matched:
+            for column in row:
+                if not _same(old[column], row[column]):
+                    changed.append(row)
+                    break
+
+        dropped = [old for key, old in stored.items() if key not in seen]
+        inserts.append((table, added))
+        updates.append((table, pk, changed))
+        deletes.append((table, pk, keys, dropped))
+
+    counts = {}
+    for table, rows in inserts:
+        if rows:
+            dbconn.execute(table.insert(), rows)
+        counts[table.name] = [len(rows), 0, 0]
+
+    for table, pk, rows in updates:
+        if rows:
+            statement = table.update().where(table.c[pk]==bindparam('b_' + pk))
+            params = []
+            for row in rows:
+                row = dict(row)
+                row['b_' + pk] = row.pop(pk)
+                params.append(row)
+            dbconn.execute(statement, params)
+        counts[table.name][1] = len(rows)
+
+    # Children go before their parents
+    deletes.reverse()
+    for table, pk, keys, rows in deletes:
+        if rows:
+            if pk is None:
+                pk_keys = keys
+            else:
+                pk_keys = (pk,)
+            statement = table.delete().where(and_(*[table.c[key]==bindparam('b_' + key) for key in pk_keys]))
+            dbconn.execute(statement, [dict([('b_' + key, row[key]) for key in pk_keys]) for row in rows])
+        counts[table.name][2] = len(rows)
+
+    for table_name in counts:
+        counts[table_name] = tuple(counts[table_name])
+    return counts
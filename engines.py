@@ -0,0 +1,133 @@
+""" Engines and connection pools shared by everything in a process
+
+    get_engine() hands out one engine per database URL, created under a lock with our
+    schema already in place, so any number of cccReaders, in any number of threads, share
+    its pool. In-memory SQLite gets a StaticPool, a single connection every thread uses,
+    since each pooled connection would otherwise be a private database of its own. SQLite
+    files run in WAL mode with a busy timeout, server databases get pool_size connections.
+
+    Readers on a shared engine take turns a phase at a time through phase_lock(), which
+    also stops their client side id allocation racing. bulk_load() turns SQLite's fsyncs
+    off while a load is running, and can hold the lookup indexes back until it's done.
+"""
+
+import dblayer as db_layer
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import ResourceClosedError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+default_pool_size = 5
+default_max_overflow = 10
+sqlite_busy_timeout = 30   # Seconds a writer waits on another connection's lock
+
+_lock = threading.Lock()
+_engines = {}
+_phase_locks = {}
+_bulk_loads = {}
+_index_lock = threading.Lock()
+_deferred_loads = {}
+
+def is_sqlite(url):
+    return make_url(url).drivername.startswith('sqlite')
+
+def is_memory_sqlite(url):
+    return is_sqlite(url) and make_url(url).database in (None, '', ':memory:')
+
+def cte_rows(query):
+    """ Returns the rows of a query that starts WITH (a CTE) as a list
+
+        Python 2's sqlite3 only describes the columns of a statement that finds nothing when
+        it starts with SELECT, so SQLAlchemy takes an empty WITH for one with no result set.
+    """
+    try:
+        return query.all()
+    except ResourceClosedError:
+        if not is_sqlite(query.session.get_bind().url):
+            raise
+        return []
+
+def _watch_sqlite(engine):
+    """ Sets our pragmas on each connection, synchronous following whether a bulk load is running """
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        synchronous = _bulk_loads.get(engine) and 'OFF' or 'NORMAL'
+        if connection_record.info.get('synchronous') != synchronous:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA synchronous=%s' % (synchronous))
+            cursor.close()
+            connection_record.info['synchronous'] = synchronous
+
+    event.listen(engine, 'connect', connect)
+    event.listen(engine, 'checkout', checkout)
+
+def new_engine(url, echo=False, pool_size=default_pool_size, max_overflow=default_max_overflow, profile='query'):
+    """ Creates an engine pooled and tuned for its kind of database, with our schema created (see
+        db_layer.create_schema for the profiles) """
+    if is_memory_sqlite(url):
+        engine = create_engine(url, echo=echo, poolclass=StaticPool, connect_args={'check_same_thread': False})
+    elif is_sqlite(url):
+        engine = create_engine(url, echo=echo, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                               connect_args={'check_same_thread': False, 'timeout': sqlite_busy_timeout})
+        _watch_sqlite(engine)
+    else:
+        engine = create_engine(url, echo=echo, pool_size=pool_size, max_overflow=max_overflow)
+
+    db_layer.create_schema(engine, profile)
+    return engine
+
+def get_engine(url, echo=False, pool_size=default_pool_size, max_overflow=default_max_overflow, profile='query'):
+    """ Returns the shared engine for a URL, creating it the first time (whose settings then stick) """
+    with _lock:
+        if url not in _engines:
+            _engines[url] = new_engine(url, echo, pool_size, max_overflow, profile)
+        return _engines[url]
+
+def phase_lock(engine):
+    """ Returns the lock readers sharing this engine hold while they run a phase """
+    with _lock:
+        if engine not in _phase_locks:
+            _phase_locks[engine] = threading.RLock()
+        return _phase_locks[engine]
+
+@contextmanager
+def bulk_load(engine, defer_indexes=False):
+    """ Runs a load with SQLite's synchronous off, trading safety against power loss mid load for speed
+
+        Connections pick the setting up as they're checked out, so a session already holding
+        one gets it from its next transaction. Anything other than a SQLite file keeps its
+        settings. With defer_indexes the lookup indexes are dropped for the load and rebuilt
+        once the last deferring load on the engine finishes, which pays off for big loads
+        (or an empty database) but not for a small load into a big one.
+    """
+    if engine is None:
+        yield
+        return
+
+    fsyncs = is_sqlite(engine.url) and not is_memory_sqlite(engine.url)
+    if fsyncs:
+        with _lock:
+            _bulk_loads[engine] = _bulk_loads.get(engine, 0) + 1
+    if defer_indexes:
+        with _index_lock:
+            if not _deferred_loads.get(engine):
+                db_layer.drop_lookup_indexes(engine)
+            _deferred_loads[engine] = _deferred_loads.get(engine, 0) + 1
+    try:
+        yield
+    finally:
+        if defer_indexes:
+            with _index_lock:
+                _deferred_loads[engine] -= 1
+                if not _deferred_loads[engine]:
+                    db_layer.build_lookup_indexes(engine)
+        if fsyncs:
+            with _lock:
+                _bulk_loads[engine] -= 1
@@ -0,0 +1,258 @@
+""" Fleet loads, each array into a SQLite shard of its own
+
+    ingest funnels every export through a single writer, so a fleet loads no faster than
+    one connection can write. Here each worker parses an export as ingest's do, then
+    writes it straight into <shard dir>/<NAS serial>.db and commits on its own, so arrays
+    load side by side without waiting on each other's write lock. A shard only ever holds
+    one array, loading it again only writes what changed (see delta), and exports already
+    in their shard aren't parsed at all. Exports of the same array (a day's dump and the
+    next) go to the same worker and are loaded one after the other in the order given, so
+    the later one always ends up in the shard.
+
+    merge() folds shards into one database afterwards, each array in a transaction of its
+    own that replaces whatever that database held for the same NAS serial.
+"""
+
+import cccReader
+import dblayer as db_layer
+import delta
+import engines
+import glob
+import ingest
+import multiprocessing
+import os
+import re
+import sys
+import time
+from itertools import imap
+from optparse import OptionParser
+from sqlalchemy import Integer, select
+from sqlalchemy.orm import sessionmaker
+
+# Set in each worker by _init_worker
+_shard_dir = None
+
+def shard_url(shard_dir, serial):
+    """ Returns the SQLite URL of an array's shard, its serial made safe for a file name """
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', serial)
+    return 'sqlite:///' + os.path.abspath(os.path.join(shard_dir, name + '.db'))
+
+def find_shards(shard_dir):
+    return ['sqlite:///' + os.path.abspath(path) for path in sorted(glob.glob(os.path.join(shard_dir, '*.db')))]
+
+def shard_hashes(shard_dir):
+    """ Returns the hashes of the exports every shard holds """
+    hashes = set()
+    for url in find_shards(shard_dir):
+        engine = engines.new_engine(url)
+        session = sessionmaker(bind=engine)()
+        try:
+            hashes.update(delta.loaded_hashes(session))
+        finally:
+            session.close()
+            engine.dispose()
+    return hashes
+
+def _text_ids(table):
+    """ Returns the text columns of a table that hold integer ids, like the mover ids in RODMID/RWDMID """
+    return [column.key for column in table.columns
+            if not isinstance(column.type, Integer) and
+               [fk for fk in column.foreign_keys if isinstance(fk.column.type, Integer)]]
+
+def shard_batches(url):
+    """ Reads a shard back as [(table name, rows)], like a BatchSink collects, ready for delta """
+    engine = engines.new_engine(url)
+    batches = []
+    try:
+        connection = engine.connect()
+        try:
+            for table in db_layer.Base.metadata.sorted_tables:
+                if table.name not in delta.natural_keys:
+                    continue
+                rows = [dict(row) for row in connection.execute(select([table]))]
+                # Ids stored as text go back to the integers a parse would have handed delta
+                for column in _text_ids(table):
+                    for row in rows:
+                        if row[column] is not None:
+                            row[column] = int(row[column])
+                batches.append((table.name, rows))
+        finally:
+            connection.close()
+    finally:
+        engine.dispose()
+    return batches
+
+def _init_worker(shard_dir, lun_index, streaming, skip_hashes, instrument, cache_dir=None):
+    global _shard_dir
+    _shard_dir = shard_dir
+    ingest._init_worker(lun_index, streaming, skip_hashes, instrument, cache_dir)
+
+def group_by_serial(files):
+    """ Returns the files as a list of groups, one per NAS serial in the order each was first
+        seen, each group's files in the order given. A file whose serial can't be read from its
+        header makes a group of its own, its parse then reports why. """
+    groups = {}
+    order = []
+    for path in files:
+        try:
+            key = cccReader.read_nas_serial(path)
+        except (SystemExit, Exception):  # cccReader exits on unreadable files
+            key = None
+        if key is None:
+            key = (path,)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(path)
+    return [groups[key] for key in order]
+
+def _load_shard(path):
+    """ Worker side, parses one export and writes it to its array's shard
+
+        Returns (path, shard URL, rows, error, seconds, report), shard and rows are None if
+        the parse or the write failed or the export was already in its shard.
+    """
+    path, batches, error, seconds, report = ingest._parse_file(path)
+    if batches is None:
+        return path, None, None, error, seconds, report
+
+    start = time.time()
+    try:
+        serial = [rows for table, rows in batches if table == 'NAS'][0][0]['SerialNumber']
+        url = shard_url(_shard_dir, serial)
+
+        # A new shard is filled with its lookup indexes held back, see db_layer.create_schema
+        fresh = not os.path.exists(url[len('sqlite:///'):])
+        engine = engines.new_engine(url, profile=fresh and 'bulk' or 'query')
+        session = sessionmaker(bind=engine)()
+        try:
+            with engines.bulk_load(engine, fresh):
+                rows, error = ingest.load_result(session, batches, True, report)
+        finally:
+            session.close()
+            engine.dispose()
+    except Exception, e:
+        return path, None, None, "%s: %s" % (e.__class__.__name__, e), seconds + time.time() - start, report
+    if error is not None:
+        url = None
+    return path, url, rows, error, seconds + time.time() - start, report
+
+def _load_group(paths):
+    """ Worker side, loads one array's exports into its shard in the order given, see _load_shard """
+    return [_load_shard(path) for path in paths]
+
+def load_shards(files, shard_dir, jobs=None, streaming=False, instrument=False, cache_dir=None, lun_index=None):
+    """ Loads each export into its array's shard across a pool of worker processes
+
+        lun_index is the (frame serial, ALU) -> WWN catalogue disks are resolved against,
+        see cccReader.load_lun_index. Returns a list of (path, shard URL, rows, error,
+        seconds, report) in the order the arrays finished, each array's exports in the order given.
+    """
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    args = (shard_dir, lun_index or {}, streaming, shard_hashes(shard_dir), instrument, cache_dir)
+
+    # Two workers writing one shard would race, so each array's exports go to one worker
+    groups = group_by_serial(files)
+    if jobs == 1:
+        _init_worker(*args)
+        return [result for results in imap(_load_group, groups) for result in results]
+
+    pool = multiprocessing.Pool(jobs, _init_worker, args)
+    try:
+        return [result for results in pool.imap_unordered(_load_group, groups) for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+def merge(shards, db_engine=ingest.default_db_engine, db_debug=False):
+    """ Folds shards (SQLite URLs) into one database, a transaction per array
+
+        Shards whose export the database already has are skipped. Returns a list of
+        (shard URL, rows, error), rows is None for a skipped shard.
+    """
+    db = engines.get_engine(db_engine, db_debug)
+    session = sessionmaker(bind=db)()
+
+    # Filling an empty database, the lookup indexes are cheaper built once at the end
+    defer_indexes = session.query(db_layer.NAS).count() == 0
+    session.commit()
+
+    merged = []
+    try:
+        with engines.bulk_load(db, defer_indexes):
+            for url in shards:
+                batches = shard_batches(url)
+                hashes = delta.batch_hashes(batches)
+                if not hashes or any([delta.is_loaded(session, export_hash) for export_hash in hashes]):
+                    session.commit()
+                    merged.append((url, None, None))
+                    continue
+                rows, error = ingest.load_result(session, batches, True)
+                merged.append((url, rows, error))
+    finally:
+        session.close()
+    return merged
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] -s DIR [export.xml|directory ...]")
+    parser.add_option('-s', '--shards', dest='shard_dir', default=None, metavar='DIR',
+                      help="load each array into its own SQLite shard in DIR")
+    parser.add_option('-d', '--db', dest='db_engine', default=None,
+                      help="then merge every shard in DIR into this SQLAlchemy database")
+    parser.add_option('-l', '--luns', dest='lun_engine', default=None, metavar='URL',
+                      help="resolve disk WWNs against the LUN catalogue in this database [default: the --db one]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help="number of loader processes [default: one per CPU]")
+    parser.add_option('--streaming', dest='streaming', action='store_true', default=False,
+                      help="stream each export rather than loading it whole")
+    parser.add_option('-c', '--cache', dest='cache_dir', default=None, metavar='DIR',
+                      help="keep parsed snapshots in DIR and load unchanged exports from there")
+    parser.add_option('--debug', dest='db_debug', action='store_true', default=False,
+                      help="echo the SQL we issue while merging")
+    options, args = parser.parse_args(argv)
+    if not options.shard_dir:
+        parser.error("a shard directory please")
+
+    files = ingest.find_exports(args)
+    if args and not files:
+        parser.error("no CCC exports given")
+    if not files and not options.db_engine:
+        parser.error("exports to load, a database to merge into, or both please")
+
+    failed = 0
+    if files:
+        lun_index = {}
+        lun_engine = options.lun_engine or options.db_engine
+        if lun_engine:
+            session = sessionmaker(bind=engines.get_engine(lun_engine))()
+            try:
+                lun_index = cccReader.load_lun_index(session)
+            finally:
+                session.close()
+
+        loaded = load_shards(files, options.shard_dir, options.jobs, options.streaming, False, options.cache_dir,
+                             lun_index)
+        for path, url, rows, error, seconds, report in sorted(loaded):
+            if error is None and url is None:
+                print "SKIP  %s (already in its shard)" % (path)
+            elif error is None:
+                print "OK    %s -> %s (%d rows, %.2fs)" % (path, url, rows, seconds)
+            else:
+                failed += 1
+                print "FAIL  %s: %s" % (path, error)
+
+    if options.db_engine:
+        for url, rows, error in merge(find_shards(options.shard_dir), options.db_engine, options.db_debug):
+            if error is None and rows is None:
+                print "SKIP  %s (already merged)" % (url)
+            elif error is None:
+                print "MERGE %s (%d rows)" % (url, rows)
+            else:
+                failed += 1
+                print "FAIL  %s: %s" % (url, error)
+
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
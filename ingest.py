@@ -0,0 +1,276 @@
+""" Parallel ingestion of many CCC exports into one database
+
+    Each export is parsed in a worker process by a cccReader with a BatchSink, so workers
+    never touch the database. Their row batches come back to a single writer that owns
+    the connection and loads each export in its own transaction, which keeps every core
+    busy parsing without fighting over SQLite's write lock.
+"""
+
+import cccReader
+import dblayer as db_layer
+import delta
+import engines
+import glob
+import instrumentation
+import json
+import multiprocessing
+import os
+import sinks
+import snapshot
+import sys
+import time
+from itertools import imap
+from optparse import OptionParser
+from sqlalchemy import *
+from sqlalchemy.orm import sessionmaker
+
+default_db_engine = 'sqlite:////tmp/slough.db'
+
+# Set in each worker by _init_worker
+_lun_index = None
+_streaming = False
+_skip_hashes = set()
+_instrument = False
+_cache = None
+_lun_digest = None
+
+def _init_worker(lun_index, streaming, skip_hashes, instrument, cache_dir=None):
+    global _lun_index, _streaming, _skip_hashes, _instrument, _cache, _lun_digest
+    _lun_index = lun_index
+    _streaming = streaming
+    _skip_hashes = skip_hashes
+    _instrument = instrument
+    _cache = None
+    if cache_dir:
+        _cache = snapshot.SnapshotCache(cache_dir)
+        _lun_digest = snapshot.lun_index_digest(lun_index)
+
+def worker_args(session, skip_loaded):
+    """ Returns (lun_index, skip_hashes) for _init_worker, with skip_loaded the hashes of the
+        exports already in the database so workers don't parse them again """
+    # Workers can't see the database, so they get the LUN catalogue up front
+    lun_index = cccReader.load_lun_index(session)
+    skip_hashes = set()
+    if skip_loaded:
+        skip_hashes = delta.loaded_hashes(session)
+    return lun_index, skip_hashes
+
+def _parse_file(path):
+    """ Worker side, parses one export into (table, rows) batches
+
+        Returns (path, batches, error, seconds, report), batches is None if the parse failed
+        or, with no error, if the export is already loaded and was skipped. report is the
+        reader's ParseReport when instrumenting. With a snapshot cache, exports already in
+        it aren't parsed at all, their report has a single 'snapshot' phase instead.
+    """
+    batches = []
+    start = time.time()
+    try:
+        export_hash = delta.file_hash(path)
+        if export_hash in _skip_hashes:
+            return path, None, None, time.time() - start, None
+
+        if _cache is not None:
+            loading = time.time()
+            reader = snapshot.parse_cached(path, _cache, _streaming, _lun_index, export_hash, _instrument,
+                                            _lun_digest)
+            batches = reader.batches()
+            reader.close()
+            if _instrument and reader.report is None:
+                # Straight from the cache, there's no parse to report so the snapshot read stands in for it
+                reader.report = instrumentation.ParseReport(path)
+                stats = reader.report.add_phase('snapshot')
+                stats.seconds = time.time() - loading
+                stats.rows = sum([len(rows) for table, rows in batches])
+                stats.peak_rss_kb = instrumentation.peak_rss_kb()
+        else:
+            reader = cccReader.cccReader(path,
+                                         streaming=_streaming,
+                                         sink=sinks.BatchSink(lambda table, rows: batches.append((table, rows))),
+                                         lun_index=_lun_index,
+                                         instrument=_instrument)
+            reader.export_hash = export_hash
+            reader.parse()
+    except (SystemExit, IOError):  # cccReader exits on unreadable files, that mustn't take the worker down
+        return path, None, "Unable to read and/or access file", time.time() - start, None
+    except Exception, e:
+        return path, None, "%s: %s" % (e.__class__.__name__, e), time.time() - start, None
+    return path, batches, None, time.time() - start, reader.report
+
+def _id_columns(table):
+    """ Returns (column, table) pairs for every integer key in a table that the writer has to shift """
+    columns = []
+    for column in table.columns:
+        if column.primary_key and isinstance(column.type, Integer):
+            columns.append((column.key, table.name))
+        for fk in column.foreign_keys:
+            if isinstance(fk.column.type, Integer):
+                columns.append((column.key, fk.column.table.name))
+    return columns
+
+def write_batches(session, batches):
+    """ Writes one export's batches, shifting its ids past what's already in the database
+
+        Workers number their rows from 1, so every integer primary key, and every foreign key
+        pointing at one, is offset by the current max of the table it belongs to.
+        Returns the number of rows written, the caller owns the transaction.
+    """
+    offsets = {}
+    for table in db_layer.Base.metadata.sorted_tables:
+        pk = list(table.primary_key)
+        if len(pk) == 1 and isinstance(pk[0].type, Integer):
+            offsets[table.name] = session.query(func.max(pk[0])).scalar() or 0
+
+    written = 0
+    for table_name, rows in batches:
+        table = db_layer.Base.metadata.tables[table_name]
+        shifts = [(column, offsets[target]) for column, target in _id_columns(table) if offsets.get(target)]
+        for row in rows:
+            for column, offset in shifts:
+                if row[column] is not None:
+                    row[column] += offset
+        session.execute(table.insert(), rows)
+        written += len(rows)
+    return written
+
+def load_result(session, batches, incremental=False, report=None):
+    """ Writer side, loads one worker's batches in a transaction of their own
+
+        Returns (rows, error), error is None if the batches were committed. With a report
+        (the worker's ParseReport), the write is added to it as a 'write' phase.
+    """
+    if report is not None:
+        stats = report.add_phase('write')
+        counter = instrumentation.StatementCounter(session.get_bind())
+        counter.attach()
+        start = time.time()
+
+    error = None
+    try:
+        if incremental:
+            rows = 0
+            for inserted, updated, deleted in delta.apply_delta(session, batches).values():
+                rows += inserted + updated + deleted
+        else:
+            rows = write_batches(session, batches)
+        session.commit()
+    except Exception, e:
+        session.rollback()
+        rows = 0
+        error = "%s: %s" % (e.__class__.__name__, e)
+
+    if report is not None:
+        counter.detach()
+        stats.seconds = time.time() - start
+        stats.statements = counter.count
+        stats.rows = rows
+        stats.peak_rss_kb = instrumentation.peak_rss_kb()
+    return rows, error
+
+def find_exports(paths):
+    """ Expands directories into the .xml exports they hold """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.xml'))))
+        else:
+            files.append(path)
+    return files
+
+def ingest(files, db_engine=default_db_engine, jobs=None, streaming=False, db_debug=False, incremental=False,
+           instrument=False, cache_dir=None):
+    """ Parses files across a pool of worker processes and loads them through a single writer
+
+        With incremental, exports already loaded are skipped and the rest only write what
+        changed for their NAS (see delta). Returns a list of (path, rows, error, seconds, report)
+        in the order given, rows is None for a skipped export. With instrument,
+        report is the worker's ParseReport plus a 'write' phase for the writer, otherwise None.
+        With a cache_dir, parsed exports are kept there as snapshots and not parsed again.
+    """
+    db = engines.get_engine(db_engine, db_debug)
+    session = sessionmaker(bind=db)()
+
+    lun_index, skip_hashes = worker_args(session, incremental)
+
+    # Filling an empty database, the lookup indexes are cheaper built once at the end
+    defer_indexes = not incremental and session.query(db_layer.NAS).count() == 0
+    session.commit()
+
+    if jobs == 1:
+        pool = None
+        _init_worker(lun_index, streaming, skip_hashes, instrument, cache_dir)
+        results = imap(_parse_file, files)
+    else:
+        pool = multiprocessing.Pool(jobs, _init_worker, (lun_index, streaming, skip_hashes, instrument, cache_dir))
+        # Results are written in the order given, so of two exports of the same NAS (a day's
+        # dump and the next) the later one is loaded last, however long each took to parse
+        results = pool.imap(_parse_file, files)
+
+    summary = []
+    try:
+        with engines.bulk_load(db, defer_indexes):
+            for path, batches, error, seconds, report in results:
+                rows = 0
+                if batches is None and error is None:
+                    rows = None
+                elif error is None:
+                    rows, error = load_result(session, batches, incremental, report)
+                summary.append((path, rows, error, seconds, report))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        session.close()
+
+    return summary
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] export.xml|directory ...")
+    parser.add_option('-d', '--db', dest='db_engine', default=default_db_engine,
+                      help="SQLAlchemy database URL to load into [default: %default]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help="number of parser processes [default: one per CPU]")
+    parser.add_option('-s', '--streaming', dest='streaming', action='store_true', default=False,
+                      help="stream each export rather than loading it whole")
+    parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                      help="skip exports already loaded and only write what changed for each NAS")
+    parser.add_option('-r', '--report', dest='report', default=None, metavar='FILE',
+                      help="write per file, per phase timings and counters to FILE as JSON")
+    parser.add_option('-c', '--cache', dest='cache_dir', default=None, metavar='DIR',
+                      help="keep parsed snapshots in DIR and load unchanged exports from there")
+    parser.add_option('--debug', dest='db_debug', action='store_true', default=False,
+                      help="echo the SQL we issue")
+    options, args = parser.parse_args(argv)
+
+    files = find_exports(args)
+    if not files:
+        parser.error("no CCC exports given")
+
+    summary = ingest(files, options.db_engine, options.jobs, options.streaming, options.db_debug, options.incremental,
+                     options.report is not None, options.cache_dir)
+
+    if options.report:
+        reports = [report.to_dict() for path, rows, error, seconds, report in sorted(summary) if report is not None]
+        output = open(options.report, 'w')
+        try:
+            json.dump(reports, output, indent=2)
+        finally:
+            output.close()
+
+    failed = 0
+    skipped = 0
+    for path, rows, error, seconds, report in sorted(summary):
+        if error is None and rows is None:
+            skipped += 1
+            print "SKIP  %s (already loaded)" % (path)
+        elif error is None:
+            print "OK    %s (%d rows, %.2fs)" % (path, rows, seconds)
+        else:
+            failed += 1
+            print "FAIL  %s: %s" % (path, error)
+    print "%d of %d exports loaded, %d already loaded" % (len(summary) - failed - skipped, len(summary), skipped)
+
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
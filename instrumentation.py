@@ -0,0 +1,96 @@
+""" Opt-in timing and counters for cccReader.parse()
+
+    A ParseReport holds one PhaseStats per phase (wall time, entries read, rows written,
+    SQL statements sent and the process's peak RSS once the phase finished), so it's easy
+    to see whether XML walking, inserts or the LUN lookups dominate on a given array.
+"""
+
+import json
+from sqlalchemy import event
+
+try:
+    import resource
+except ImportError:  # No getrusage on Windows, we just go without memory figures
+    resource = None
+
+def peak_rss_kb():
+    """ High water mark of this process's resident memory in KB, None if we can't tell """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class PhaseStats(object):
+    """ Counters for a single parse phase """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.elements = 0
+        self.rows = 0
+        self.statements = 0
+        self.peak_rss_kb = None
+
+    def __repr__(self):
+        return "PhaseStats<%s: %.3fs, %d elements, %d rows, %d statements>" % \
+                    (self.name, self.seconds, self.elements, self.rows, self.statements)
+
+    def to_dict(self):
+        return {'name': self.name,
+                'seconds': self.seconds,
+                'elements': self.elements,
+                'rows': self.rows,
+                'statements': self.statements,
+                'peak_rss_kb': self.peak_rss_kb}
+
+class ParseReport(object):
+    """ Per-phase stats for one export """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.phases = []
+
+    def __repr__(self):
+        return "ParseReport<%s: %d phases, %.3fs>" % (self.source, len(self.phases), self.seconds)
+
+    def __str__(self):
+        lines = ["%-20s %10s %10s %10s %10s %12s" % ('phase', 'seconds', 'elements', 'rows', 'statements', 'peak_rss_kb')]
+        for phase in self.phases:
+            lines.append("%-20s %10.3f %10d %10d %10d %12s" % (phase.name, phase.seconds, phase.elements,
+                                                              phase.rows, phase.statements, phase.peak_rss_kb))
+        lines.append("%-20s %10.3f" % ('total', self.seconds))
+        return "\n".join(lines)
+
+    def add_phase(self, name):
+        stats = PhaseStats(name)
+        self.phases.append(stats)
+        return stats
+
+    @property
+    def seconds(self):
+        return sum([phase.seconds for phase in self.phases])
+
+    def to_dict(self):
+        return {'source': self.source,
+                'seconds': self.seconds,
+                'phases': [phase.to_dict() for phase in self.phases]}
+
+    def to_json(self, indent=None):
+        return json.dumps(self.to_dict(), indent=indent)
+
+class StatementCounter(object):
+    """ Counts the statements an engine sends while attached, an executemany counts once """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def attach(self):
+        if self.engine is not None:
+            event.listen(self.engine, 'before_cursor_execute', self._count)
+
+    def detach(self):
+        if self.engine is not None:
+            event.remove(self.engine, 'before_cursor_execute', self._count)
@@ -0,0 +1,141 @@
+""" Volume lineage over a loaded database, each question one recursive CTE query
+
+    VolumeRelationship holds the meta/stripe/slice/disk hierarchy, a volume's parents
+    being the volumes it's built on. Down is filesystem to disks and their LUNs, up is
+    disk (or LUN) to the filesystems and shares on top of it. Rather than walking
+    Volume.parents a lazy load at a time, each walk is a WITH RECURSIVE the database
+    runs in one go, so a failing LUN's impact is one query however deep the graph.
+
+    The walks are UNIONs, so a volume reached along several stripes is only visited once
+    and a cycle in the graph still ends. SQL Server only allows UNION ALL there, which is
+    fine for the acyclic graphs exports actually have.
+"""
+
+import dblayer as db_layer
+import engines
+import sys
+from optparse import OptionParser
+from sqlalchemy import or_
+from sqlalchemy.orm import sessionmaker
+
+def _recurse(session, walk, step):
+    if session.get_bind().dialect.name == 'mssql':
+        return walk.union_all(step)
+    return walk.union(step)
+
+def _walk_down(session, seed):
+    """ Returns a CTE of (key, volume_id) for every volume at or below the seed's (key, volume_id) rows """
+    relationship = db_layer.VolumeRelationship
+    walk = seed.cte('walk_down', recursive=True)
+    step = session.query(walk.c.key, relationship.c.ParentID).filter(relationship.c.VolumeID == walk.c.volume_id)
+    return _recurse(session, walk, step)
+
+def _walk_up(session, seed):
+    """ Returns a CTE of (key, volume_id) for every volume at or above the seed's (key, volume_id) rows """
+    relationship = db_layer.VolumeRelationship
+    walk = seed.cte('walk_up', recursive=True)
+    step = session.query(walk.c.key, relationship.c.VolumeID).filter(relationship.c.ParentID == walk.c.volume_id)
+    return _recurse(session, walk, step)
+
+def _filesystem_seed(session, client_ids, serial_number):
+    """ (client id, volume) for the given clients, or every filesystem (checkpoints left out) """
+    seed = session.query(db_layer.Client.client_id.label('key'), db_layer.Client.volume_id.label('volume_id'))
+    if client_ids is None:
+        seed = seed.filter(db_layer.Client.type != 'ckpt')
+    else:
+        seed = seed.filter(db_layer.Client.client_id.in_(list(client_ids)))
+    if serial_number is not None:
+        seed = seed.filter(db_layer.Client.serial_number == serial_number)
+    return seed
+
+def _grouped(rows):
+    grouped = {}
+    for key, value in rows:
+        grouped.setdefault(key, []).append(value)
+    return grouped
+
+def disks_below(session, client_ids=None, serial_number=None):
+    """ Returns {client id: [NASDisk]} for the disks under each client, every filesystem when
+        client_ids is None (one query) """
+    walk = _walk_down(session, _filesystem_seed(session, client_ids, serial_number))
+    query = session.query(walk.c.key, db_layer.NASDisk).select_from(walk)
+    query = query.join(db_layer.NASDisk, db_layer.NASDisk.volumeid == walk.c.volume_id).distinct()
+    return _grouped(engines.cte_rows(query))
+
+def luns_below(session, client_ids=None, serial_number=None):
+    """ Returns {client id: [LUN]} for the LUNs under each client's disks, every filesystem
+        when client_ids is None (one query) """
+    walk = _walk_down(session, _filesystem_seed(session, client_ids, serial_number))
+    query = session.query(walk.c.key, db_layer.LUN).select_from(walk)
+    query = query.join(db_layer.NASDisk, db_layer.NASDisk.volumeid == walk.c.volume_id)
+    query = query.join(db_layer.LUN, db_layer.LUN.wwn == db_layer.NASDisk.lun_wwn_id).distinct()
+    return _grouped(engines.cte_rows(query))
+
+def _disk_walk(session, disk_ids):
+    seed = session.query(db_layer.NASDisk.id.label('key'), db_layer.NASDisk.volumeid.label('volume_id'))
+    return _walk_up(session, seed.filter(db_layer.NASDisk.id.in_(list(disk_ids))))
+
+def filesystems_above(session, disk_ids):
+    """ Returns {disk id: [Client]} for the filesystems and checkpoints on each disk (one query) """
+    walk = _disk_walk(session, disk_ids)
+    query = session.query(walk.c.key, db_layer.Client).select_from(walk)
+    query = query.join(db_layer.Client, db_layer.Client.volume_id == walk.c.volume_id).distinct()
+    return _grouped(engines.cte_rows(query))
+
+def shares_above(session, disk_ids):
+    """ Returns {disk id: [Export]} for the shares of the filesystems on each disk (one query) """
+    walk = _disk_walk(session, disk_ids)
+    query = session.query(walk.c.key, db_layer.Export).select_from(walk)
+    query = query.join(db_layer.Client, db_layer.Client.volume_id == walk.c.volume_id)
+    query = query.join(db_layer.Export, db_layer.Export.client_id == db_layer.Client.client_id).distinct()
+    return _grouped(engines.cte_rows(query))
+
+def lun_impact(session, wwns):
+    """ Returns [(client, [exports])] for everything a failure of these LUNs takes out (one query)
+
+        That's the filesystems and checkpoints on their disks, plus the checkpoints of those
+        filesystems, which are no use without them, along with the shares of all of them.
+    """
+    seed = session.query(db_layer.NASDisk.id.label('key'), db_layer.NASDisk.volumeid.label('volume_id'))
+    walk = _walk_up(session, seed.filter(db_layer.NASDisk.lun_wwn_id.in_(list(wwns))))
+    # Its own CTE, so the walk is only run once for both sides of the OR below
+    on_disk = session.query(db_layer.Client.client_id.label('client_id')).select_from(walk)
+    on_disk = on_disk.join(db_layer.Client, db_layer.Client.volume_id == walk.c.volume_id).cte('on_disk')
+    clients = session.query(on_disk.c.client_id)
+
+    query = session.query(db_layer.Client, db_layer.Export)
+    query = query.outerjoin(db_layer.Export, db_layer.Export.client_id == db_layer.Client.client_id)
+    query = query.filter(or_(db_layer.Client.client_id.in_(clients), db_layer.Client.parent_client_id.in_(clients)))
+    query = query.order_by(db_layer.Client.name, db_layer.Export.share_name)
+
+    impact = []
+    for client, export in engines.cte_rows(query):
+        if not impact or impact[-1][0] is not client:
+            impact.append((client, []))
+        if export is not None:
+            impact[-1][1].append(export)
+    return impact
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] WWN ...")
+    parser.add_option('-d', '--db', dest='db_engine', default=None,
+                      help="SQLAlchemy database URL to look in")
+    options, args = parser.parse_args(argv)
+    if not options.db_engine:
+        parser.error("a database please")
+    if not args:
+        parser.error("the WWNs of the failing LUNs please")
+
+    session = sessionmaker(bind=engines.get_engine(options.db_engine))()
+    try:
+        impact = lun_impact(session, args)
+        for client, exports in impact:
+            print "%-24s %-8s %s" % (client.name, client.type, ', '.join([export.share_name for export in exports]))
+        print "%d filesystems and checkpoints, %d shares affected" % (len(impact),
+                                                                     sum([len(exports) for client, exports in impact]))
+    finally:
+        session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
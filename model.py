@@ -0,0 +1,32 @@
+""" Compact records for parsed CCC entities
+
+    cccReader fills these while it walks an export and hands them to a sink (see sinks),
+    which decides whether they end up as ORM objects, bulk inserted rows or just stay in
+    memory for analysis. They're namedtuples, so there's no per-object dict or ORM
+    instrumentation, and fields are named after the matching db_layer attributes.
+    Fields left out when building a record default to None.
+"""
+
+from collections import namedtuple
+
+def _record(name, fields):
+    record = namedtuple(name, fields)
+    record.__new__.__defaults__ = (None,) * len(record._fields)
+    return record
+
+NAS = _record('NAS', 'serial_number name control_station_1_ip control_station_2_ip')
+NASExport = _record('NASExport', 'serial_number hash loaded')
+Pool = _record('Pool', 'id name description profile in_use total_capacity used_capacity serial_number')
+Volume = _record('Volume', 'id name type poolid serial_number')
+VolumeRelationship = _record('VolumeRelationship', 'parent_id volume_id')
+Datamover = _record('Datamover', 'mover_id name mover_type serial_number')
+CIFSserver = _record('CIFSserver', 'server_id name domain ip datamover_id')
+Client = _record('Client', 'client_id name type total_size used_size free_size volume_id ro_host_id rw_host_id '
+                           'parent_client_id vpfs_id serial_number')
+ClientPool = _record('ClientPool', 'pool_id client_id')
+Export = _record('Export', 'share_id share_name share_path cifs_server_id cifs_server_name client_id serial_number')
+NASDisk = _record('NASDisk', 'id volumeid type in_use size lun_wwn_id serial_number')
+
+# In the order cccReader produces them, which is also parents before children
+record_types = (NAS, NASExport, Pool, Volume, VolumeRelationship, Datamover, CIFSserver, Client, ClientPool,
+                Export, NASDisk)
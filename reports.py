@@ -0,0 +1,106 @@
+""" Common questions asked of a loaded database, each answered in a fixed number of queries
+
+    Going through the ORM relationships one object at a time lazy loads every pool's
+    clients, every server's exports and every volume's parents in turn. Here each report
+    loads what it needs up front, relationships by selectinload/joinedload and the volume
+    hierarchy by a single recursive CTE (see lineage), so its cost doesn't grow with the array.
+
+    Every report takes an optional NAS serial number to stick to one array.
+"""
+
+import dblayer as db_layer
+import engines
+import lineage
+import sys
+from optparse import OptionParser
+from sqlalchemy.orm import contains_eager, selectinload, sessionmaker
+
+def _is_filesystem(client):
+    return client.type != 'ckpt'
+
+def _scoped(query, entity, serial_number):
+    if serial_number is not None:
+        query = query.filter(entity.serial_number == serial_number)
+    return query
+
+def _filesystems(session, serial_number=None):
+    query = session.query(db_layer.Client).filter(db_layer.Client.type != 'ckpt')
+    return _scoped(query, db_layer.Client, serial_number).order_by(db_layer.Client.name)
+
+def filesystems_per_pool(session, serial_number=None):
+    """ Returns (pool, filesystems) for every pool, checkpoints left out (2 queries) """
+    query = session.query(db_layer.Pool).options(selectinload(db_layer.Pool.clients))
+    pools = _scoped(query, db_layer.Pool, serial_number).order_by(db_layer.Pool.name).all()
+    return [(pool, sorted([client for client in pool.clients if _is_filesystem(client)], key=lambda client: client.name))
+            for pool in pools]
+
+def shares_per_cifs_server(session, serial_number=None):
+    """ Returns (server, exports) for every CIFS server, each export with its client loaded (2 queries) """
+    query = session.query(db_layer.CIFSserver).outerjoin(db_layer.CIFSserver.datamover)
+    query = query.options(contains_eager(db_layer.CIFSserver.datamover),
+                          selectinload(db_layer.CIFSserver.exports).joinedload(db_layer.Export.client))
+    servers = _scoped(query, db_layer.Datamover, serial_number).order_by(db_layer.CIFSserver.name).all()
+    return [(server, sorted(server.exports, key=lambda export: export.share_name)) for server in servers]
+
+def checkpoints_per_filesystem(session, serial_number=None):
+    """ Returns (filesystem, checkpoints) for every filesystem (2 queries) """
+    filesystems = _filesystems(session, serial_number).options(selectinload(db_layer.Client.children)).all()
+    return [(filesystem, sorted(filesystem.children, key=lambda client: client.name)) for filesystem in filesystems]
+
+def luns_per_filesystem(session, serial_number=None):
+    """ Returns (filesystem, LUNs) for every filesystem, the LUNs under its disks (2 queries, see lineage) """
+    filesystems = _filesystems(session, serial_number).all()
+    luns = lineage.luns_below(session, serial_number=serial_number)
+    return [(filesystem, sorted(luns.get(filesystem.client_id, []), key=lambda lun: lun.alu))
+            for filesystem in filesystems]
+
+def _print_pools(session, serial_number):
+    for pool, filesystems in filesystems_per_pool(session, serial_number):
+        print "%s (%d filesystems)" % (pool.name, len(filesystems))
+        for filesystem in filesystems:
+            print "    %s" % (filesystem.name)
+
+def _print_shares(session, serial_number):
+    for server, exports in shares_per_cifs_server(session, serial_number):
+        print "%s on %s (%d shares)" % (server.name, server.datamover.name, len(exports))
+        for export in exports:
+            print "    %-30s %s" % (export.share_name, export.client and export.client.name or export.share_path)
+
+def _print_checkpoints(session, serial_number):
+    for filesystem, checkpoints in checkpoints_per_filesystem(session, serial_number):
+        print "%s (%d checkpoints)" % (filesystem.name, len(checkpoints))
+        for checkpoint in checkpoints:
+            print "    %s" % (checkpoint.name)
+
+def _print_luns(session, serial_number):
+    for filesystem, luns in luns_per_filesystem(session, serial_number):
+        print "%s (%d LUNs)" % (filesystem.name, len(luns))
+        for lun in luns:
+            print "    %-6s %s" % (lun.alu, lun.wwn)
+
+reports = {'pools': _print_pools,
+           'shares': _print_shares,
+           'checkpoints': _print_checkpoints,
+           'luns': _print_luns}
+
+def main(argv):
+    parser = OptionParser(usage="%%prog [options] %s" % ('|'.join(sorted(reports))))
+    parser.add_option('-d', '--db', dest='db_engine', default=None,
+                      help="SQLAlchemy database URL to report on")
+    parser.add_option('-n', '--nas', dest='serial_number', default=None, metavar='SERIAL',
+                      help="only report on the NAS with this serial number")
+    options, args = parser.parse_args(argv)
+    if not options.db_engine:
+        parser.error("a database please")
+    if len(args) != 1 or args[0] not in reports:
+        parser.error("one of %s please" % (', '.join(sorted(reports))))
+
+    session = sessionmaker(bind=engines.get_engine(options.db_engine))()
+    try:
+        reports[args[0]](session, options.serial_number)
+    finally:
+        session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
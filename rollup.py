@@ -0,0 +1,237 @@
+""" Capacity rollups per NAS, pool, data mover and CIFS server
+
+    Works from record columns, either a ColumnarSink's or db_columns() over a loaded
+    database, rather than walking ORM relationships. Each client is reduced to its
+    measures once, then every level is a list of (group, client, share) edges summed in
+    one go, by numpy's bincount when numpy is installed and a single Python pass when not.
+
+    A filesystem spread over several pools is split evenly between them, so pool figures
+    add up to their NAS, though it counts as one of the filesystems on each. Checkpoints
+    count as checkpoint overhead, not total/used/free.
+"""
+
+import cccReader
+import columnar
+import engines
+import json
+import model
+import sinks
+import sys
+from itertools import izip
+from optparse import OptionParser
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+levels = ('nas', 'pool', 'datamover', 'cifs_server')
+measures = ('filesystems', 'total', 'used', 'free', 'checkpoint')
+capacities = ('capacity_total', 'capacity_used', 'capacity_free')
+
+def db_columns(dbconn):
+    """ Returns a columns(record_type) function reading whole tables from a database """
+    def columns(record_type):
+        table, keys, mapped = sinks.table_for(record_type)
+        rows = dbconn.execute(select([table.c[key] for key in keys])).fetchall()
+        values = [list(column) for column in zip(*rows)] or [[] for field in record_type._fields]
+        return dict(zip(record_type._fields, values))
+    return columns
+
+def _index(keys):
+    """ Maps keys to their positions """
+    return dict(izip(keys, xrange(len(keys))))
+
+def _group_sum(groups, positions, shares, values, size):
+    """ Sums values[position] (times its share) into size buckets by group """
+    if numpy is not None:
+        weights = numpy.asarray(values, dtype=numpy.float64)[numpy.asarray(positions, dtype=numpy.intp)]
+        if shares is not None:
+            weights *= numpy.asarray(shares, dtype=numpy.float64)
+        return numpy.bincount(numpy.asarray(groups, dtype=numpy.intp), weights=weights, minlength=size).tolist()
+
+    sums = [0] * size
+    if shares is None:
+        for group, position in izip(groups, positions):
+            sums[group] += values[position]
+    else:
+        for group, position, share in izip(groups, positions, shares):
+            sums[group] += values[position] * share
+    return sums
+
+def _whole(value):
+    if value == int(value):
+        return int(value)
+    return value
+
+def _client_measures(clients):
+    """ Reduces each client to its measures, checkpoints only count as overhead """
+    values = dict([(measure, []) for measure in measures])
+    for client_type, total, used, free in izip(clients['type'], clients['total_size'], clients['used_size'],
+                                               clients['free_size']):
+        checkpoint = client_type == 'ckpt'
+        values['filesystems'].append(not checkpoint and 1 or 0)
+        values['total'].append(not checkpoint and total or 0)
+        values['used'].append(not checkpoint and used or 0)
+        values['free'].append(not checkpoint and free or 0)
+        values['checkpoint'].append(checkpoint and total or 0)
+    return values
+
+def _level(keys, names, serials, edges, client_values, counted=None):
+    """ Sums the client measures over edges (group, client position, share, or None for whole) """
+    groups, positions, shares = edges
+    size = len(keys)
+    sums = {}
+    for measure in measures:
+        if measure == 'filesystems' and counted is not None:
+            sums[measure] = _group_sum(groups, positions, None, counted, size)
+        else:
+            sums[measure] = _group_sum(groups, positions, shares, client_values[measure], size)
+
+    rows = []
+    for position, key in enumerate(keys):
+        row = {'key': key, 'name': names[position], 'serial_number': serials[position]}
+        for measure in measures:
+            row[measure] = _whole(sums[measure][position])
+        rows.append(row)
+    return rows
+
+def rollup(columns):
+    """ Rolls client capacity up every level
+
+        columns is a function taking a model record type and returning {field: list of
+        values}, like ColumnarSink.columns or db_columns(). Returns {level: list of rows},
+        each row a dict of key, name, serial_number and the measures. Pool and NAS rows
+        also carry the pools' own capacities.
+    """
+    clients = columns(model.Client)
+    client_values = _client_measures(clients)
+    client_index = _index(clients['client_id'])
+    client_count = len(clients['client_id'])
+
+    nas = columns(model.NAS)
+    pools = columns(model.Pool)
+    movers = columns(model.Datamover)
+    servers = columns(model.CIFSserver)
+    client_pools = columns(model.ClientPool)
+    exports = columns(model.Export)
+
+    report = {}
+
+    # NAS, straight from each client's serial
+    nas_index = _index(nas['serial_number'])
+    edges = ([], [], None)
+    for position, serial in enumerate(clients['serial_number']):
+        if serial in nas_index:
+            edges[0].append(nas_index[serial])
+            edges[1].append(position)
+    report['nas'] = _level(nas['serial_number'], nas['name'], nas['serial_number'], edges, client_values)
+
+    # Pools, through the client pool edge list, each client shared evenly between its pools
+    pool_index = _index(pools['id'])
+    pool_counts = [0] * client_count
+    for client_id in client_pools['client_id']:
+        if client_id in client_index:
+            pool_counts[client_index[client_id]] += 1
+    edges = ([], [], [])
+    for pool_id, client_id in izip(client_pools['pool_id'], client_pools['client_id']):
+        if pool_id in pool_index and client_id in client_index:
+            position = client_index[client_id]
+            edges[0].append(pool_index[pool_id])
+            edges[1].append(position)
+            edges[2].append(1.0 / pool_counts[position])
+    report['pool'] = _level(pools['id'], pools['name'], pools['serial_number'], edges, client_values,
+                            counted=client_values['filesystems'])
+
+    # Data movers, by whichever mover has the client mounted. The mount columns are text in
+    # the database, so movers are looked up by their id as a string too
+    mover_index = _index(movers['mover_id'])
+    mover_index.update(_index([str(mover_id) for mover_id in movers['mover_id']]))
+    edges = ([], [], None)
+    for position, (rw_host, ro_host) in enumerate(izip(clients['rw_host_id'], clients['ro_host_id'])):
+        host = rw_host is not None and rw_host or ro_host
+        if host in mover_index:
+            edges[0].append(mover_index[host])
+            edges[1].append(position)
+    report['datamover'] = _level(movers['mover_id'], movers['name'], movers['serial_number'], edges, client_values)
+
+    # CIFS servers, by the clients they share out, each client once however many shares it has
+    server_index = _index(servers['server_id'])
+    mover_serials = dict(zip(movers['mover_id'], movers['serial_number']))
+    server_serials = [mover_serials.get(mover_id) for mover_id in servers['datamover_id']]
+    edges = ([], [], None)
+    seen = set()
+    for pair in izip(exports['cifs_server_id'], exports['client_id']):
+        if pair in seen or pair[0] not in server_index or pair[1] not in client_index:
+            continue
+        seen.add(pair)
+        edges[0].append(server_index[pair[0]])
+        edges[1].append(client_index[pair[1]])
+    report['cifs_server'] = _level(servers['server_id'], servers['name'], server_serials, edges, client_values)
+
+    # The pools' own capacities, per pool and summed per NAS
+    pool_free = [(total or 0) - (used or 0) for total, used in izip(pools['total_capacity'], pools['used_capacity'])]
+    pool_values = {'capacity_total': [total or 0 for total in pools['total_capacity']],
+                   'capacity_used': [used or 0 for used in pools['used_capacity']],
+                   'capacity_free': pool_free}
+    for row, total, used, free in izip(report['pool'], pool_values['capacity_total'], pool_values['capacity_used'],
+                                       pool_free):
+        row.update(capacity_total=total, capacity_used=used, capacity_free=free)
+
+    groups, positions = [], []
+    for position, serial in enumerate(pools['serial_number']):
+        if serial in nas_index:
+            groups.append(nas_index[serial])
+            positions.append(position)
+    for capacity in capacities:
+        sums = _group_sum(groups, positions, None, pool_values[capacity], len(report['nas']))
+        for row, value in izip(report['nas'], sums):
+            row[capacity] = _whole(value)
+
+    return report
+
+def _print_level(level, rows):
+    columns = measures
+    if level in ('pool', 'nas'):
+        columns = measures + capacities
+    print "%-11s %-24s" % (level, 'name') + ''.join(["%16s" % (column) for column in columns])
+    for row in rows:
+        print "%-11s %-24s" % (level, row['name']) + ''.join(["%16.0f" % (row[column]) for column in columns])
+    print
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] [export.xml]")
+    parser.add_option('-d', '--db', dest='db_engine', default=None,
+                      help="roll up everything loaded in this SQLAlchemy database rather than an export")
+    parser.add_option('-l', '--level', dest='levels', action='append', choices=levels, default=None,
+                      help="only report this level, may be repeated [default: all of them]")
+    parser.add_option('-j', '--json', dest='json', default=None, metavar='FILE',
+                      help="also write the rollup to FILE as JSON")
+    options, args = parser.parse_args(argv)
+    if len(args) > 1 or bool(args) == bool(options.db_engine):
+        parser.error("either one export or a database please")
+
+    if options.db_engine:
+        session = sessionmaker(bind=engines.get_engine(options.db_engine))()
+        report = rollup(db_columns(session))
+        session.close()
+    else:
+        sink = columnar.ColumnarSink()
+        cccReader.cccReader(args[0], streaming=True, sink=sink).parse()
+        report = rollup(sink.columns)
+
+    for level in options.levels or levels:
+        _print_level(level, report[level])
+
+    if options.json:
+        output = open(options.json, 'w')
+        try:
+            json.dump(report, output, indent=2)
+        finally:
+            output.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
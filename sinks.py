@@ -0,0 +1,103 @@
+""" Where cccReader's parsed records go
+
+    A sink gets batches of model records, all of one type, through write() and is told when
+    each parse phase ends through end_phase(). CoreSink bulk inserts them (the default),
+    ORMSink builds db_layer objects, BatchSink hands table rows to a callable (ingest and
+    delta work this way) and MemorySink keeps the records for analysis without any database.
+"""
+
+import dblayer as db_layer
+import model
+
+# The db_layer class (or association table, with its columns) each record type lands in
+_targets = {model.NAS: db_layer.NAS,
+            model.NASExport: db_layer.NASExport,
+            model.Pool: db_layer.Pool,
+            model.Volume: db_layer.Volume,
+            model.VolumeRelationship: (db_layer.VolumeRelationship, ('ParentID', 'VolumeID')),
+            model.Datamover: db_layer.Datamover,
+            model.CIFSserver: db_layer.CIFSserver,
+            model.Client: db_layer.Client,
+            model.ClientPool: (db_layer.ClientPoolRelationship, ('PoolID', 'ClientID')),
+            model.Export: db_layer.Export,
+            model.NASDisk: db_layer.NASDisk}
+
+_tables = {}
+
+def table_for(record_type):
+    """ Returns (table, column key for each field, db_layer class or None) for a record type """
+    if record_type not in _tables:
+        target = _targets[record_type]
+        if isinstance(target, tuple):
+            table, columns = target
+            mapped = None
+        else:
+            table = target.__table__
+            columns = tuple([getattr(target, field).property.columns[0].key for field in record_type._fields])
+            mapped = target
+        _tables[record_type] = (table, columns, mapped)
+    return _tables[record_type]
+
+def as_rows(records):
+    """ Converts a batch of records to column keyed dicts for their table """
+    table, columns, mapped = table_for(type(records[0]))
+    return [dict(zip(columns, record)) for record in records]
+
+class CoreSink(object):
+    """ Bulk inserts each batch with a single executemany, one commit per phase """
+
+    def __init__(self, session):
+        self.session = session
+
+    def write(self, records):
+        table, columns, mapped = table_for(type(records[0]))
+        self.session.execute(table.insert(), as_rows(records))
+
+    def end_phase(self):
+        self.session.commit()
+
+class ORMSink(object):
+    """ Adds each record as a db_layer object, for callers that want the session populated """
+
+    def __init__(self, session):
+        self.session = session
+
+    def write(self, records):
+        table, columns, mapped = table_for(type(records[0]))
+        if mapped is None:
+            # Association rows have no class of their own, so the objects they point at must be in first
+            self.session.flush()
+            self.session.execute(table.insert(), as_rows(records))
+        else:
+            self.session.add_all([mapped(**dict(zip(record._fields, record))) for record in records])
+
+    def end_phase(self):
+        self.session.commit()
+
+class BatchSink(object):
+    """ Hands each batch to callback(table name, rows) as column keyed dicts """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, records):
+        table, columns, mapped = table_for(type(records[0]))
+        self.callback(table.name, as_rows(records))
+
+    def end_phase(self):
+        pass
+
+class MemorySink(object):
+    """ Keeps every record, by type, no database involved """
+
+    def __init__(self):
+        self.records = dict([(record_type, []) for record_type in model.record_types])
+
+    def __getitem__(self, record_type):
+        return self.records[record_type]
+
+    def write(self, records):
+        self.records[type(records[0])].extend(records)
+
+    def end_phase(self):
+        pass
@@ -0,0 +1,327 @@
+""" Binary snapshots of parsed exports, cached by file hash and LUN catalogue
+
+    A snapshot holds every record type column by column: whole numbers as int64 arrays,
+    text as one UTF-8 blob plus an int64 offsets array, each with a null mask if it needs
+    one, behind a small JSON header saying where everything is. Snapshots are mmapped when
+    opened and columns are only decoded when asked for (with numpy, arrays() over a whole
+    number column is a view straight onto the map), so opening one costs next to nothing.
+
+    SnapshotCache keeps them in a directory named by file hash and drops the least recently
+    used once it holds more than max_entries. Disk WWNs are resolved against the LUN
+    catalogue while parsing, so snapshots are filed under a digest of that catalogue too and
+    a changed catalogue means parsing again. parse_cached() is the usual way in: it hands
+    back the snapshot for an export, parsing and caching it first if it has to.
+"""
+
+import cccReader
+import columnar
+import datetime
+import delta
+import hashlib
+import json
+import mmap
+import model
+import os
+import sinks
+import struct
+import tempfile
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+magic = 'CCCSNAP4'   # Bumped whenever the model records change shape
+_datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+def lun_index_digest(lun_index):
+    """ SHA1 of a (frame serial, ALU) -> WWN LUN catalogue, see cccReader.load_lun_index """
+    digest = hashlib.sha1()
+    for key, wwn in sorted((lun_index or {}).items()):
+        digest.update(repr((key, wwn)))
+    return digest.hexdigest()
+
+def _int64s(values):
+    """ Packs whole numbers into little endian int64s """
+    return struct.pack('<%dq' % len(values), *values)
+
+def _unpack_int64s(data):
+    return struct.unpack('<%dq' % (len(data) // 8), data)
+
+def _kind(values):
+    """ Works out how a column is stored: int, text, datetime or null (nothing but None) """
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            kinds.add('int')
+        elif isinstance(value, basestring):
+            kinds.add('text')
+        elif isinstance(value, datetime.datetime):
+            kinds.add('datetime')
+        else:
+            raise TypeError("can't snapshot a %s" % (value.__class__.__name__))
+    if not kinds:
+        return 'null'
+    if len(kinds) > 1:
+        raise TypeError("can't snapshot a column mixing %s" % (', '.join(sorted(kinds))))
+    return kinds.pop()
+
+def _encode(values):
+    """ Returns (kind, [data blocks]) for a column, the null mask first if there are any gaps """
+    kind = _kind(values)
+    if kind == 'null':
+        return kind, []
+
+    blocks = []
+    if None in values:
+        blocks.append(''.join([value is None and '\x01' or '\x00' for value in values]))
+    else:
+        blocks.append(None)
+
+    if kind == 'int':
+        blocks.append(_int64s([value or 0 for value in values]))
+        return kind, blocks
+
+    if kind == 'datetime':
+        values = [value is not None and value.strftime(_datetime_format) or None for value in values]
+    encoded = [value is not None and (isinstance(value, unicode) and value.encode('utf-8') or value) or ''
+               for value in values]
+    offsets = [0]
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    blocks.append(_int64s(offsets))
+    blocks.append(''.join(encoded))
+    return kind, blocks
+
+def write(path, columns, export_hash=None):
+    """ Writes a snapshot of every record type, columns is a function like ColumnarSink.columns
+
+        The file is written alongside path and renamed into place, so readers never see
+        half a snapshot.
+    """
+    header = {'hash': export_hash, 'types': {}}
+    data = []
+    position = 0
+    for record_type in model.record_types:
+        values = columns(record_type)
+        count = len(values[record_type._fields[0]])
+        fields = {}
+        for field in record_type._fields:
+            kind, blocks = _encode(values[field])
+            locations = []
+            for block in blocks:
+                if block is None:
+                    locations.append(None)
+                    continue
+                locations.append((position, len(block)))
+                data.append(block)
+                position += len(block)
+                padding = -position % 8   # Keep every block 8 byte aligned so int64s can be viewed in place
+                data.append('\x00' * padding)
+                position += padding
+            fields[field] = {'kind': kind, 'blocks': locations}
+        header['types'][record_type.__name__] = {'count': count, 'fields': fields}
+
+    encoded_header = json.dumps(header)
+    start = len(magic) + 4 + len(encoded_header)
+    start += -start % 8
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.snapshot', dir=directory)
+    output = os.fdopen(handle, 'wb')
+    try:
+        try:
+            output.write(magic)
+            output.write(struct.pack('<I', start))
+            output.write(encoded_header)
+            output.write('\x00' * (start - len(magic) - 4 - len(encoded_header)))
+            for block in data:
+                output.write(block)
+        finally:
+            output.close()
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class Snapshot(object):
+    """ A snapshot opened for reading, see columns(), arrays(), records() and batches() """
+
+    def __init__(self, path):
+        self.path = path
+        self.report = None   # parse_cached() leaves the ParseReport here when it had to parse
+        source = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            source.close()
+
+        if self._map[:len(magic)] != magic:
+            self._map.close()
+            raise ValueError("%s isn't a snapshot" % (path))
+        start = struct.unpack('<I', self._map[len(magic):len(magic) + 4])[0]
+        header = json.loads(self._map[len(magic) + 4:start].rstrip('\x00'))
+        self.export_hash = header['hash']
+        self._types = header['types']
+        self._start = start   # Block offsets count from the end of the header
+        self._columns = {}
+
+    def __repr__(self):
+        return "Snapshot<%s>" % (self.path)
+
+    def close(self):
+        self._map.close()
+
+    def count(self, record_type):
+        return self._types[record_type.__name__]['count']
+
+    def _block(self, location):
+        offset, length = location
+        offset += self._start
+        return self._map[offset:offset + length]
+
+    def _decode(self, count, kind, blocks):
+        if kind == 'null':
+            return [None] * count
+
+        if kind == 'int':
+            values = list(_unpack_int64s(self._block(blocks[1])))
+        else:
+            offsets = _unpack_int64s(self._block(blocks[1]))
+            text = self._block(blocks[2])
+            values = [text[offsets[position]:offsets[position + 1]] for position in xrange(count)]
+            if kind == 'datetime':
+                values = [value and datetime.datetime.strptime(value, _datetime_format) or None for value in values]
+            else:
+                values = [value.decode('utf-8') for value in values]
+
+        if blocks[0] is not None:
+            nulls = self._block(blocks[0])
+            values = [value if nulls[position] == '\x00' else None for position, value in enumerate(values)]
+        return values
+
+    def columns(self, record_type):
+        """ Returns {field: list of values} for a record type, decoding it the first time it's asked for """
+        if record_type not in self._columns:
+            stored = self._types[record_type.__name__]
+            self._columns[record_type] = dict([(field, self._decode(stored['count'], stored['fields'][field]['kind'],
+                                                                   stored['fields'][field]['blocks']))
+                                               for field in record_type._fields])
+        return self._columns[record_type]
+
+    def arrays(self, record_type):
+        """ Returns {field: numpy array}, whole number columns with no gaps are views onto the snapshot """
+        stored = self._types[record_type.__name__]
+        arrays = {}
+        for field in record_type._fields:
+            kind = stored['fields'][field]['kind']
+            blocks = stored['fields'][field]['blocks']
+            if kind == 'int' and blocks[0] is None:
+                arrays[field] = numpy.frombuffer(self._map, dtype='<i8', count=stored['count'],
+                                                 offset=self._start + blocks[1][0])
+            else:
+                arrays[field] = columnar.as_array(self.columns(record_type)[field])
+        return arrays
+
+    def records(self, record_type):
+        columns = self.columns(record_type)
+        return [record_type(*values) for values in izip(*[columns[field] for field in record_type._fields])]
+
+    def replay(self, sink, batch_size=1000):
+        """ Feeds every record to a sink, as cccReader would have, in a single phase
+
+            The export is stamped as loaded now rather than when the snapshot was parsed.
+        """
+        now = datetime.datetime.now()
+        for record_type in model.record_types:
+            records = self.records(record_type)
+            if record_type is model.NASExport:
+                records = [record._replace(loaded=now) for record in records]
+            for start in xrange(0, len(records), batch_size):
+                sink.write(records[start:start + batch_size])
+        sink.end_phase()
+
+    def batches(self):
+        """ Returns [(table name, rows)] like a BatchSink collects, ready for ingest or delta """
+        batches = []
+        self.replay(sinks.BatchSink(lambda table, rows: batches.append((table, rows))))
+        return batches
+
+class SnapshotCache(object):
+    """ A directory of snapshots named by export hash and LUN digest (see lun_index_digest), least
+        recently used dropped past max_entries """
+
+    def __init__(self, directory, max_entries=64):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def __repr__(self):
+        return "SnapshotCache<%s: %d of %d>" % (self.directory, len(self._entries()), self.max_entries)
+
+    def path_for(self, export_hash, lun_digest):
+        return os.path.join(self.directory, '%s-%s.snap' % (export_hash, lun_digest))
+
+    def _entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.snap')]
+
+    def get(self, export_hash, lun_digest):
+        """ Returns the snapshot for an export hash and LUN digest, or None, marking it as recently used """
+        path = self.path_for(export_hash, lun_digest)
+        try:
+            os.utime(path, None)
+            return Snapshot(path)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def put(self, export_hash, lun_digest, columns):
+        """ Snapshots columns (a function like ColumnarSink.columns) under an export hash and LUN digest """
+        path = self.path_for(export_hash, lun_digest)
+        write(path, columns, export_hash)
+        self.evict()
+        return path
+
+    def evict(self):
+        """ Drops the least recently used snapshots until we're down to max_entries """
+        entries = []
+        for path in self._entries():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass  # Someone else evicted it already
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def parse_cached(ccc_config_xml, cache, streaming=True, lun_index=None, export_hash=None, instrument=False,
+                 lun_digest=None):
+    """ Returns the Snapshot for an export, parsing (and caching) it only if the cache hasn't got it
+
+        Disks are resolved against lun_index, so the cache only has the export if it was
+        parsed against the same catalogue. Pass lun_digest (see lun_index_digest()) to save
+        working it out again for every export.
+    """
+    if export_hash is None:
+        export_hash = delta.file_hash(ccc_config_xml)
+    if lun_digest is None:
+        lun_digest = lun_index_digest(lun_index)
+    snapshot = cache.get(export_hash, lun_digest)
+    if snapshot is not None:
+        return snapshot
+
+    sink = columnar.ColumnarSink(formats=())
+    reader = cccReader.cccReader(ccc_config_xml, streaming=streaming, sink=sink, lun_index=lun_index,
+                                 instrument=instrument)
+    reader.export_hash = export_hash
+    reader.parse()
+    snapshot = Snapshot(cache.put(export_hash, lun_digest, sink.columns))
+    snapshot.report = reader.report
+    return snapshot
@@ -0,0 +1,280 @@
+""" Long running ingestion service for a spool directory of CCC exports
+
+    A watcher thread polls the spool for new .xml files and, once a file has stopped
+    growing, hands it to the same worker processes ingest uses. Parsed batches queue up
+    for a single writer thread that owns the database connection. At most jobs + queue_size
+    exports are in flight at once, so a flood of drops waits in the spool directory rather
+    than in memory. Loaded exports move to done/, anything that fails to failed/. An export
+    that's already loaded, however many times it's dropped, is skipped and moves to done/.
+    Only one export per NAS serial is in flight at a time, taken in the order they were
+    noticed, so of a day's dump and the next dropped together the later one is loaded last.
+"""
+
+import Queue
+import cccReader
+import collections
+import delta
+import engines
+import ingest
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from optparse import OptionParser
+from sqlalchemy.orm import sessionmaker
+
+def _init_worker(lun_index, streaming, skip_hashes, instrument):
+    # Ctrl-C is the service's to handle, a worker dying of it mid parse would leave stop() waiting on it forever
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ingest._init_worker(lun_index, streaming, skip_hashes, instrument)
+
+class SpoolService(object):
+    """ Watches spool_dir and loads every export dropped into it """
+
+    def __init__(self, spool_dir, db_engine=ingest.default_db_engine, jobs=None, queue_size=4, poll_interval=2.0,
+                 incremental=True, streaming=False, db_debug=False, log=None):
+        self.spool_dir = spool_dir
+        self.done_dir = os.path.join(spool_dir, 'done')
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.db_engine = db_engine
+        self.db_debug = db_debug
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.incremental = incremental
+        self.streaming = streaming
+        self.log = log or _print
+
+        self.loaded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.latencies = collections.deque(maxlen=100)  # Seconds from a file appearing to it being committed
+
+        self._queue = Queue.Queue()
+        self._slots = threading.Semaphore(self.jobs + self.queue_size)
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._settling = {}      # path -> (size, mtime) at the last poll
+        self._noticed = {}       # path -> when we first saw it
+        self._serials = {}       # path -> NAS serial, read once it has settled
+        self._in_flight = {}     # path -> NAS serial
+        self._pool = None
+        self._writer = None
+        self._watcher = None
+        self._session = None
+
+    def __repr__(self):
+        return "SpoolService<%s: %d loaded, %d failed, %d queued>" % (self.spool_dir, self.loaded, self.failed,
+                                                                       self._queue.qsize())
+
+    def stats(self):
+        """ Current queue depth, in flight count, totals and recent per-file latency """
+        latencies = list(self.latencies)
+        stats = {'queue_depth': self._queue.qsize(),
+                 'in_flight': len(self._in_flight),
+                 'loaded': self.loaded,
+                 'failed': self.failed,
+                 'skipped': self.skipped,
+                 'last_latency': None,
+                 'mean_latency': None,
+                 'max_latency': None}
+        if latencies:
+            stats['last_latency'] = latencies[-1]
+            stats['mean_latency'] = sum(latencies) / len(latencies)
+            stats['max_latency'] = max(latencies)
+        return stats
+
+    def start(self):
+        for path in (self.done_dir, self.failed_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        db = engines.get_engine(self.db_engine, self.db_debug)
+        self._session = sessionmaker(bind=db)()
+
+        lun_index, skip_hashes = ingest.worker_args(self._session, True)
+        self._session.commit()
+
+        self._pool = multiprocessing.Pool(self.jobs, _init_worker,
+                                          (lun_index, self.streaming, skip_hashes, False))
+        self._writer = threading.Thread(target=self._write, name='spool-writer')
+        self._writer.start()
+        self._watcher = threading.Thread(target=self._watch, name='spool-watcher')
+        self._watcher.start()
+
+    def stop(self):
+        """ Stops picking up files and waits for everything in flight to be written """
+        self._stopping.set()
+        if self._watcher:
+            self._watcher.join()
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+        self._queue.put(None)
+        if self._writer:
+            self._writer.join()
+        if self._session:
+            self._session.close()
+
+    def terminate(self):
+        """ Stops without waiting for exports still being parsed, they stay in the spool for next time """
+        self._stopping.set()
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+        self._queue.put(None)
+        if self._writer:
+            self._writer.join()
+        if self._session:
+            self._session.close()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self._stopping.isSet():
+                self._stopping.wait(1.0)
+        except KeyboardInterrupt:
+            pass
+        try:
+            self.stop()
+        except KeyboardInterrupt:
+            self.terminate()   # Asked again while we waited on the exports in flight
+
+    def poll(self):
+        """ Submits every export that has settled since the last poll, as far as we have slots for """
+        seen = {}
+        settled = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if not name.endswith('.xml') or not os.path.isfile(path) or path in self._in_flight:
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue  # Gone again already
+            seen[path] = (info.st_size, info.st_mtime)
+            self._noticed.setdefault(path, time.time())
+
+            # Only take files that haven't changed since the last poll, they may still be being written
+            if self._settling.get(path) == seen[path]:
+                settled.append(path)
+        self._settling = seen
+        for path in self._noticed.keys():
+            if path not in seen:
+                del self._noticed[path]
+                self._serials.pop(path, None)
+
+        # Workers finish in any order, so an export waits while an earlier one of its NAS is in flight
+        with self._lock:
+            busy = set(self._in_flight.values())
+        for path in sorted(settled, key=lambda path: (self._noticed[path], path)):
+            serial = self._serial(path)
+            if serial in busy:
+                continue
+            if not self._slots.acquire(False):
+                break  # Everything's busy, the rest wait in the spool
+            busy.add(serial)
+            with self._lock:
+                self._in_flight[path] = serial
+            noticed = self._noticed.pop(path)
+            del self._serials[path]
+            self._pool.apply_async(ingest._parse_file, (path,),
+                                   callback=lambda result, noticed=noticed: self._queue.put((noticed, result)))
+
+    def _serial(self, path):
+        """ The NAS serial of a settled export, one whose header can't be read stands on its own """
+        if path not in self._serials:
+            try:
+                serial = cccReader.read_nas_serial(path)
+            except (SystemExit, Exception):  # cccReader exits on unreadable files, the parse reports why
+                serial = None
+            self._serials[path] = serial or (path,)
+        return self._serials[path]
+
+    def _watch(self):
+        while not self._stopping.isSet():
+            self.poll()
+            self._stopping.wait(self.poll_interval)
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            noticed, (path, batches, error, seconds, report) = item
+
+            rows = 0
+            if batches is None and error is None:
+                rows = None
+            elif error is None and self._is_loaded(batches):
+                rows = None
+            elif error is None:
+                rows, error = ingest.load_result(self._session, batches, self.incremental)
+            self._finish(path, noticed, rows, error)
+
+    def _is_loaded(self, batches):
+        """ Whether the export has been loaded since the workers were handed their skip set,
+            dropped again while running or twice at once """
+        loaded = any([delta.is_loaded(self._session, export_hash) for export_hash in delta.batch_hashes(batches)])
+        self._session.commit()
+        return loaded
+
+    def _finish(self, path, noticed, rows, error):
+        if error is None:
+            target = self.done_dir
+        else:
+            target = self.failed_dir
+        try:
+            os.rename(path, os.path.join(target, os.path.basename(path)))
+        except OSError, e:
+            error = error or "Unable to move export out of the spool: %s" % (e)
+
+        latency = time.time() - noticed
+        self.latencies.append(latency)
+        if error is not None:
+            self.failed += 1
+            self.log("FAIL  %s: %s" % (path, error))
+        elif rows is None:
+            self.skipped += 1
+            self.log("SKIP  %s (already loaded)" % (path))
+        else:
+            self.loaded += 1
+            self.log("OK    %s (%d rows, %.2fs latency, %d queued)" % (path, rows, latency, self._queue.qsize()))
+
+        with self._lock:
+            self._in_flight.pop(path, None)
+        self._slots.release()
+
+def _print(message):
+    print message
+    sys.stdout.flush()
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] spool_directory")
+    parser.add_option('-d', '--db', dest='db_engine', default=ingest.default_db_engine,
+                      help="SQLAlchemy database URL to load into [default: %default]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help="number of parser processes [default: one per CPU]")
+    parser.add_option('-q', '--queue', dest='queue_size', type='int', default=4,
+                      help="parsed exports allowed to wait for the writer [default: %default]")
+    parser.add_option('-p', '--poll', dest='poll_interval', type='float', default=2.0,
+                      help="seconds between looks at the spool [default: %default]")
+    parser.add_option('-s', '--streaming', dest='streaming', action='store_true', default=False,
+                      help="stream each export rather than loading it whole")
+    parser.add_option('--full', dest='incremental', action='store_false', default=True,
+                      help="load every export in full rather than only what changed for its NAS")
+    parser.add_option('--debug', dest='db_debug', action='store_true', default=False,
+                      help="echo the SQL we issue")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("one spool directory please")
+
+    service = SpoolService(args[0], options.db_engine, options.jobs, options.queue_size, options.poll_interval,
+                           options.incremental, options.streaming, options.db_debug)
+    service.serve_forever()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,224 @@
+""" Synthetic Celerra CCC exports for benchmarking
+
+    Builds an export shaped like the real thing: storage pools, disks carved into slices,
+    slices striped together and wrapped in as many levels of meta volume as asked for,
+    filesystems (plus their checkpoints) on top, data movers mounting and sharing them,
+    and the disk list tying everything back to LUNs. The file is written as it's built,
+    so even the biggest exports never sit in memory.
+"""
+
+import math
+import sys
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+default_config = {'pools': 4,
+                  'filesystems': 100,
+                  'checkpoints': 50,      # Spread over the first filesystems, one each
+                  'shares': 100,          # Spread over the filesystems round robin
+                  'data_movers': 2,
+                  'cifs_servers': 2,      # Per data mover
+                  'stripe_width': 4,      # Slices per stripe, one stripe per filesystem
+                  'meta_depth': 2,        # Levels of meta volume above each stripe
+                  'slices_per_disk': 4,
+                  'name': 'synthetic',
+                  'serial': 'APM-SYNTHETIC',
+                  'frame_serial': 'APM00000000001',
+                  'namespace': True}
+
+def _objects_per_filesystem(config):
+    """ Roughly how many objects each filesystem brings with it, used to size scaled exports """
+    width = config['stripe_width']
+    per_fs = width + 1 + config['meta_depth']                 # slices, stripe and metas
+    per_fs += 2.0 * width / config['slices_per_disk']         # disk volumes and their Disk entries
+    per_fs += 1                                               # the filesystem itself
+    per_fs += float(config['checkpoints']) / config['filesystems']
+    per_fs += float(config['shares']) / config['filesystems']
+    return per_fs
+
+def scaled_config(objects, **overrides):
+    """ Returns a config producing roughly this many objects, keeping default_config's proportions """
+    config = dict(default_config)
+    config.update(overrides)
+    filesystems = max(1, int(objects / _objects_per_filesystem(config)))
+    config['checkpoints'] = int(config['checkpoints'] * filesystems / config['filesystems'])
+    config['shares'] = int(config['shares'] * filesystems / config['filesystems'])
+    config['filesystems'] = filesystems
+    return config
+
+def disk_count(config):
+    return int(math.ceil(float(config['filesystems'] * config['stripe_width']) / config['slices_per_disk']))
+
+def lun_catalogue(config):
+    """ Returns the (frame serial, ALU, WWN) behind every generated disk, root disk first """
+    luns = []
+    for alu in range(disk_count(config) + 1):
+        luns.append((config['frame_serial'], alu, '60060160%s%08X' % (config['frame_serial'][-8:], alu)))
+    return luns
+
+def _mover(config, fs_index):
+    return 'server_%d' % (2 + fs_index % config['data_movers'])
+
+def _cifs_server(config, mover_index, server_index):
+    return 'CIFS%02d%02d' % (mover_index, server_index)
+
+def generate(output, **overrides):
+    """ Writes a synthetic export to output (a path or file object)
+
+        Returns a dict of how many of each kind of object it holds.
+    """
+    config = dict(default_config)
+    config.update(overrides)
+
+    if hasattr(output, 'write'):
+        _write(output, config)
+    else:
+        target = open(output, 'w')
+        try:
+            _write(target, config)
+        finally:
+            target.close()
+
+    filesystems = config['filesystems']
+    disks = disk_count(config) + 1
+    counts = {'pools': config['pools'],
+              'volumes': disks + filesystems * (config['stripe_width'] + 1 + config['meta_depth']),
+              'filesystems': filesystems + 1,
+              'checkpoints': min(config['checkpoints'], filesystems),
+              'shares': config['shares'],
+              'data_movers': config['data_movers'],
+              'cifs_servers': config['data_movers'] * config['cifs_servers'],
+              'disks': disks}
+    counts['objects'] = sum(counts.values())
+    return counts
+
+def _write(out, config):
+    filesystems = config['filesystems']
+    width = config['stripe_width']
+    depth = config['meta_depth']
+    spd = config['slices_per_disk']
+    disks = disk_count(config)
+    checkpoints = min(config['checkpoints'], filesystems)
+    pool_size = 1024 * 1024
+
+    if config['namespace']:
+        out.write('<?xml version="1.0"?>\n<CCC xmlns="http://www.emc.com/celerra">\n <Version>1.4</Version>\n')
+    else:
+        out.write('<?xml version="1.0"?>\n<CCC>\n <Version>1.3</Version>\n')
+
+    out.write(' <Celerra>\n  <Name>%s</Name>\n  <Serial>%s</Serial>\n' % (escape(config['name']), escape(config['serial'])))
+    out.write('  <Control_Station><IP_Address>10.0.0.1</IP_Address></Control_Station>\n')
+
+    # Pools, the last one is left empty so in_use gets both answers
+    out.write('  <Storage_Pools>\n')
+    for pool in range(config['pools']):
+        used = pool + 1 < config['pools'] and pool_size / 2 or pool_size
+        out.write('   <Storage_Pool><Name>pool_%d</Name><Description>synthetic pool %d</Description>'
+                  '<Disk_Type>CLSTD</Disk_Type><Total_Capacity>%d</Total_Capacity>'
+                  '<Used_Capacity>%d</Used_Capacity></Storage_Pool>\n' % (pool, pool, pool_size, used))
+    out.write('  </Storage_Pools>\n')
+
+    # Volumes, bottom up: disks -> slices (pool members) -> stripes -> metas -> filesystem
+    out.write('  <Volumes>\n')
+    out.write('   <Volume><Name>root_disk</Name><Type>disk</Type><Client_Names>root_fs_1</Client_Names></Volume>\n')
+    for disk in range(disks):
+        slices = ['s%d' % s for s in range(disk * spd, min((disk + 1) * spd, filesystems * width))]
+        out.write('   <Volume><Name>d%d</Name><Type>disk</Type><Client_Names>%s</Client_Names></Volume>\n' %
+                  (disk, ' '.join(slices)))
+    for fs in range(filesystems):
+        pool = fs % config['pools']
+        for s in range(fs * width, (fs + 1) * width):
+            out.write('   <Volume><Name>s%d</Name><Type>slice</Type><Storage_Pool_Name>pool_%d</Storage_Pool_Name>'
+                      '<Client_Names>stv%d</Client_Names></Volume>\n' % (s, pool, fs))
+        above = depth and 'mtv%d_1' % fs or 'fs%d' % fs
+        out.write('   <Volume><Name>stv%d</Name><Type>stripe</Type><Client_Names>%s</Client_Names></Volume>\n' % (fs, above))
+        for level in range(1, depth + 1):
+            above = level < depth and 'mtv%d_%d' % (fs, level + 1) or 'fs%d' % fs
+            if level == depth and fs < checkpoints:
+                above += ' ckpt%d' % fs
+            out.write('   <Volume><Name>mtv%d_%d</Name><Type>meta</Type><Client_Names>%s</Client_Names></Volume>\n' %
+                      (fs, level, above))
+    out.write('  </Volumes>\n')
+
+    # Filesystems, checkpoints and the avm_group entries the real exports carry for pools
+    out.write('  <File_Systems>\n')
+    out.write('   <File_System><Name>root_fs_1</Name><Type>uxfs</Type><Size_Allocated>256</Size_Allocated>'
+              '<Size_Used>128</Size_Used><Volume_Name>root_disk</Volume_Name></File_System>\n')
+    for fs in range(filesystems):
+        top = depth and 'mtv%d_%d' % (fs, depth) or 'stv%d' % fs
+        out.write('   <File_System><Name>fs%d</Name><Type>uxfs</Type><Size_Allocated>%d</Size_Allocated>'
+                  '<Size_Used>%d</Size_Used><Volume_Name>%s</Volume_Name></File_System>\n' %
+                  (fs, 1024 + fs, 512 + fs % 512, top))
+    for fs in range(checkpoints):
+        top = depth and 'mtv%d_%d' % (fs, depth) or 'stv%d' % fs
+        out.write('   <File_System><Name>ckpt%d</Name><Type>ckpt</Type><Size_Allocated>64</Size_Allocated>'
+                  '<Size_Used>8</Size_Used><Volume_Name>%s</Volume_Name><Backup_Of>fs%d</Backup_Of></File_System>\n' %
+                  (fs, top, fs))
+    for pool in range(config['pools']):
+        out.write('   <File_System><Name>pool_%d</Name><Type>avm_group</Type></File_System>\n' % pool)
+    out.write('  </File_Systems>\n')
+
+    # Data movers mount their share of the filesystems and serve the shares on them
+    out.write('  <Data_Movers>\n')
+    for mover in range(config['data_movers']):
+        name = 'server_%d' % (2 + mover)
+        out.write('   <Data_Mover><Name>%s</Name><Role>primary</Role>\n    <Network>\n' % name)
+        for server in range(config['cifs_servers']):
+            out.write('     <Interface><Name>cge%d</Name><IP>10.%d.%d.1</IP></Interface>\n' % (server, mover, server))
+        out.write('    </Network>\n    <CIFS>\n')
+        for server in range(config['cifs_servers']):
+            out.write('     <Server><Name>%s</Name><Domain>SYNTHETIC</Domain><Interface>cge%d</Interface></Server>\n' %
+                      (_cifs_server(config, mover, server), server))
+        for share in range(config['shares']):
+            fs = share % filesystems
+            if _mover(config, fs) != name:
+                continue
+            servers = [_cifs_server(config, mover, server) for server in range(config['cifs_servers'])]
+            out.write('     <Share><Name>share%d</Name><Path_Standard>/fs%d/dir%d</Path_Standard>'
+                      '<Servers>%s</Servers></Share>\n' % (share, fs, share, ' '.join(servers)))
+        out.write('    </CIFS>\n    <Mounts>\n')
+        for fs in range(filesystems):
+            if _mover(config, fs) == name:
+                out.write('     <Mount><File_System>fs%d</File_System><Type>rw</Type><Path>/fs%d</Path></Mount>\n' % (fs, fs))
+                if fs < checkpoints:
+                    out.write('     <Mount><File_System>ckpt%d</File_System><Type>ro</Type><Path>/ckpt%d</Path></Mount>\n' %
+                              (fs, fs))
+        out.write('    </Mounts>\n   </Data_Mover>\n')
+    out.write('  </Data_Movers>\n')
+
+    # Disks, root first, each on its own ALU of the frame
+    out.write('  <Disks>\n')
+    for alu, name in enumerate(['root_disk'] + ['d%d' % disk for disk in range(disks)]):
+        out.write('   <Disk><Name>%s</Name><Type>CLSTD</Type><In_Use>y</In_Use><Size>%d</Size><Size_Qualifier>GB</Size_Qualifier>'
+                  '<Storage_ID>%s</Storage_ID><Storage_Device>%04X</Storage_Device></Disk>\n' %
+                  (name, 11 if alu == 0 else 500, escape(config['frame_serial']), alu))
+    out.write('  </Disks>\n </Celerra>\n</CCC>\n')
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] output.xml")
+    parser.add_option('-n', '--objects', dest='objects', type='int', default=None,
+                      help="size the export to roughly this many objects")
+    parser.add_option('--no-namespace', dest='namespace', action='store_false', default=True,
+                      help="write a CCC 1.3 style export with no namespace")
+    for key in ('pools', 'filesystems', 'checkpoints', 'shares', 'data_movers', 'cifs_servers',
+                'stripe_width', 'meta_depth', 'slices_per_disk'):
+        parser.add_option('--' + key.replace('_', '-'), dest=key, type='int', default=None,
+                          help="[default: %s]" % default_config[key])
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("one output file please")
+
+    overrides = {'namespace': options.namespace}
+    for key in default_config:
+        if getattr(options, key, None) is not None and key != 'namespace':
+            overrides[key] = getattr(options, key)
+    if options.objects:
+        overrides = scaled_config(options.objects, **overrides)
+
+    counts = generate(args[0], **overrides)
+    for key in sorted(counts):
+        print "%-14s %d" % (key, counts[key])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))